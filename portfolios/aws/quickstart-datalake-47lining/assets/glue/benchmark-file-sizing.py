@@ -0,0 +1,92 @@
+"""
+Local benchmark of query-side scan time for small-file versus sized Parquet layouts.
+
+Generates a partitioned dataset with plain PySpark, writes it once the way JSON submissions used to be converted
+(many small files per dt partition) and once with write_parquet of curated-datasets-job.py, then times the same
+aggregation over both layouts. Pick --target-file-size-mb below the partition size to see files being split.
+
+    python benchmark-file-sizing.py --rows 2000000 --partitions 30 --target-file-size-mb 8 \
+        --output-root /tmp/file-sizing
+"""
+import argparse
+import importlib.util
+import os
+import time
+
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, concat, date_add, expr, lit, rand
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Parquet file sizing benchmark')
+    parser.add_argument('--rows', type=int, default=1000000, help='Number of generated rows')
+    parser.add_argument('--partitions', type=int, default=30, help='Number of dt partitions')
+    parser.add_argument('--small-files', type=int, default=200, help='Input splits of the small-file layout')
+    parser.add_argument('--runs', type=int, default=5, help='Timed runs per layout')
+    parser.add_argument('--compression', default='snappy', help='Parquet compression codec')
+    parser.add_argument('--target-file-size-mb', type=int, default=128, help='Target file size of the sized layout')
+    parser.add_argument('--output-root', required=True, help='Directory the generated layouts are written to')
+    return parser.parse_args()
+
+
+def generate(spark, rows, partitions):
+    return spark.range(rows).select(
+        col('id').alias('order_id'),
+        concat(lit('sku-'), (rand() * 5000).cast('int').cast('string')).alias('sku'),
+        (rand() * 500).alias('amount'),
+        expr("element_at(array('CA', 'NY', 'TX', 'WA', 'FL', 'IL'), cast(rand() * 6 as int) + 1)").alias('state'),
+        date_add(lit('2017-06-01'), (col('id') % partitions).cast('int')).cast('string').alias('dt'),
+    )
+
+
+def load_curated_datasets_job():
+    # The job's file name is not importable as a module name
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'curated-datasets-job.py')
+    spec = importlib.util.spec_from_file_location('curated_datasets_job', path)
+    job = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(job)
+    return job
+
+
+def list_parquet_files(path):
+    return [os.path.join(root, name) for root, _, names in os.walk(path) for name in names if name.endswith('.parquet')]
+
+
+def time_scan(spark, path, runs):
+    durations = []
+    for _ in range(runs):
+        started = time.time()
+        spark.read.parquet(path).groupBy('state').agg({'amount': 'sum'}).collect()
+        durations.append(time.time() - started)
+    return min(durations), sum(durations) / len(durations)
+
+
+def main():
+    args = parse_args()
+    spark = SparkSession.builder.appName('file-sizing-benchmark').getOrCreate()
+    df = generate(spark, args.rows, args.partitions).cache()
+    df.count()
+
+    small_files_path = os.path.join(args.output_root, 'small-files')
+    df.repartition(args.small_files).write \
+        .option('compression', args.compression) \
+        .partitionBy('dt') \
+        .parquet(small_files_path, mode='overwrite')
+    sized_path = os.path.join(args.output_root, 'sized')
+    sizing_spec = {
+        'partition_keys': ['dt'],
+        'target_file_size_mb': args.target_file_size_mb,
+        'compression': args.compression,
+    }
+    load_curated_datasets_job().write_parquet(spark, df, sized_path, sizing_spec)
+
+    for name, path in [('small-files', small_files_path), ('sized', sized_path)]:
+        files = list_parquet_files(path)
+        average_mb = sum(os.path.getsize(file_path) for file_path in files) / len(files) / 1024 ** 2
+        best, average = time_scan(spark, path, args.runs)
+        print('{:<12} files={:<6} average_file={:.1f}MiB best={:.3f}s average={:.3f}s'
+              .format(name, len(files), average_mb, best, average))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,70 +1,527 @@
+import argparse
+import json
+import math
+import os
 import sys
-from awsglue.transforms import *
-from awsglue.utils import getResolvedOptions
+from concurrent.futures import ThreadPoolExecutor
+
+from pyspark import SparkConf
 from pyspark.context import SparkContext
-from awsglue.context import GlueContext
-from awsglue.job import Job
-from pyspark.sql.functions import lit
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col
+from pyspark.sql.types import StringType, StructType
+
+try:
+    from awsglue.context import GlueContext
+    from awsglue.job import Job
+    from awsglue.utils import getResolvedOptions
+    import boto3
+except ImportError:
+    # Running outside of AWS Glue, the job falls back to a plain PySpark session
+    GlueContext = None
 
 ## @params: [JOB_NAME, datalake_submissions_database_name, datalake_curated_datasets_database_name, datalake_curated_datasets_bucket_name]
-args = getResolvedOptions(
-    sys.argv,
-    [
-        'JOB_NAME',
-        'datalake_submissions_database_name',
-        'datalake_curated_datasets_database_name',
-        'datalake_curated_datasets_bucket_name'
-    ]
-)
-
-sc = SparkContext()
-glueContext = GlueContext(sc)
-spark = glueContext.spark_session
-job = Job(glueContext)
-job.init(args['JOB_NAME'], args)
-
-## @type: DataSource
-## @args: [database = "datalake-curated-datasets", table_name = "demographics_2017_05_20_json"]
-## @return: datasource_demographics_json
-## @inputs: []
-datasource_demographics_json = glueContext.create_dynamic_frame.from_catalog(
-    database=args["datalake_curated_datasets_database_name"],
-    table_name="demographics_20170520_json"
-)
-
-## @type: Json2Parquet
-## @args: [mapping = []]
-## @return: datasource_demographics_parquet
-## @inputs: [frame = datasource_demographics_json]
-
-## @type: DataSink
-## @args: [connection_type = "s3", connection_options = {"path": "s3://datalake-curated-datasets-123456789123-us-west-2/demographics_20170520_parquet/dataset=demographics/v=2017-05-20/p=parquet"}, format = "parquet"]
-## @return: datasink_demographics_parquet
-## @inputs: [frame = datasource_demographics_parquet]
-df = datasource_demographics_json.toDF()
-df = df.drop('dataset', 'v', 'p')
-df.write.partitionBy('dt').parquet('s3://{}/demographics_20171206_parquet/dataset=demographics/v=2017-12-06/p=parquet'.format(args['datalake_curated_datasets_bucket_name']), mode='overwrite')
-
-## @type: DataSource
-## @args: [database = "datalake-curated-datasets", table_name = "products_2017_06_01_json"]
-## @return: datasource_products_json
-## @inputs: []
-datasource_products_json = glueContext.create_dynamic_frame.from_catalog(
-    database=args["datalake_curated_datasets_database_name"],
-    table_name="products_20170601_json"
-)
-
-## @type: Json2Parquet
-## @args: [mapping = []]
-## @return: datasource_products_parquet
-## @inputs: [frame = datasource_products_json]
-
-## @type: DataSink
-## @args: [connection_type = "s3", connection_options = {"path": "s3://datalake-curated-datasets-123456789123-us-west-2/products_2017-06-01_parquet/dataset=products/v=2017-06-01/p=parquet"}, format = "parquet"]
-## @return: datasink_products_parquet
-## @inputs: [frame = datasource_products_parquet]
-df = datasource_products_json.toDF()
-df = df.drop('dataset', 'v', 'p')
-df.write.partitionBy('dt').parquet('s3://{}/products_20171206_parquet/dataset=products/v=2017-12-06/p=parquet'.format(args['datalake_curated_datasets_bucket_name']), mode='overwrite')
-
-job.commit()
\ No newline at end of file
+REQUIRED_ARGS = [
+    'JOB_NAME',
+    'datalake_submissions_database_name',
+    'datalake_curated_datasets_database_name',
+    'datalake_curated_datasets_bucket_name'
+]
+## @params (optional): [datasets, max_concurrency, incremental, mode, target_file_size_mb, compression, schema_dir]
+OPTIONAL_ARGS = [
+    'datasets', 'max_concurrency', 'incremental', 'mode', 'target_file_size_mb', 'compression', 'schema_dir'
+]
+MODE_CONVERT = 'convert'
+MODE_COMPACT = 'compact'
+MODE_INFER_SCHEMAS = 'infer_schemas'
+# Pinned schemas live next to the job as schemas/<dataset>/v=<version>.json, ship them with --extra-files in Glue
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas')
+CORRUPT_RECORD_COLUMN = '_corrupt_record'
+DEFAULT_TARGET_FILE_SIZE_MB = 128
+DEFAULT_COMPRESSION = 'snappy'
+# Rows written as a Parquet sample to measure the on-disk record size used for sizing output files
+RECORD_SIZE_SAMPLE_ROWS = 50000
+
+# Datasets converted when the job is started without --datasets. Each entry names the catalog table to read,
+# the dataset name and version that make up the curated output path and the partition columns of the output.
+DEFAULT_DATASETS = [
+    {
+        'source_table': 'demographics_20170520_json',
+        'dataset': 'demographics',
+        'version': '2017-12-06',
+        'partition_keys': ['dt'],
+    },
+    {
+        'source_table': 'products_20170601_json',
+        'dataset': 'products',
+        'version': '2017-12-06',
+        'partition_keys': ['dt'],
+    },
+]
+# Partition columns of the JSON submissions that are encoded in the curated path instead
+PATH_COLUMNS = ['dataset', 'v', 'p']
+
+
+def resolve_glue_options(argv):
+    args = getResolvedOptions(argv, REQUIRED_ARGS)
+    for name in OPTIONAL_ARGS:
+        if '--{}'.format(name) in argv:
+            args.update(getResolvedOptions(argv, [name]))
+    return args
+
+
+def resolve_local_options(argv):
+    parser = argparse.ArgumentParser(description='Curated datasets job, local PySpark mode')
+    parser.add_argument('--JOB_NAME', default='curated-datasets-local')
+    parser.add_argument('--datalake_submissions_database_name', default='')
+    parser.add_argument('--datalake_curated_datasets_database_name', default='')
+    parser.add_argument('--datalake_curated_datasets_bucket_name', default='')
+    parser.add_argument('--datasets')
+    parser.add_argument('--max_concurrency')
+    parser.add_argument('--incremental')
+    parser.add_argument('--mode')
+    parser.add_argument('--target_file_size_mb')
+    parser.add_argument('--compression')
+    parser.add_argument('--schema_dir')
+    parser.add_argument('--source_root', required=True, help='Directory holding one JSON directory per source table')
+    parser.add_argument('--output_root', required=True, help='Directory the curated Parquet datasets are written to')
+    return {key: value for key, value in vars(parser.parse_args(argv[1:])).items() if value is not None}
+
+
+def load_datasets(args):
+    datasets = json.loads(args['datasets']) if 'datasets' in args else DEFAULT_DATASETS
+    for spec in datasets:
+        spec.setdefault('partition_keys', ['dt'])
+        spec.setdefault('target_file_size_mb', int(args.get('target_file_size_mb', DEFAULT_TARGET_FILE_SIZE_MB)))
+        spec.setdefault('compression', args.get('compression', DEFAULT_COMPRESSION))
+        spec.setdefault('schema_path', make_schema_path(args.get('schema_dir', SCHEMA_DIR), spec))
+        spec['pinned_schema'] = load_pinned_schema(spec['schema_path'])
+    return datasets
+
+
+def make_schema_path(schema_dir, spec):
+    return os.path.join(schema_dir, spec['dataset'], 'v={}.json'.format(spec['version']))
+
+
+def load_pinned_schema(schema_path):
+    """
+    Loads a Spark StructType JSON schema, or returns None when the dataset has no pinned schema.
+
+    The returned schema carries an extra corrupt record column that receives the raw JSON of rows which do not
+    match the pinned types.
+    """
+    if not os.path.exists(schema_path):
+        return None
+    with open(schema_path) as schema_file:
+        schema = StructType.fromJson(json.load(schema_file))
+    return schema.add(CORRUPT_RECORD_COLUMN, StringType())
+
+
+def make_target_path(output_root, spec):
+    if 'target_path' in spec:
+        return '{}/{}'.format(output_root, spec['target_path'])
+    return '{root}/{dataset}_{compact_version}_parquet/dataset={dataset}/v={version}/p=parquet'.format(
+        root=output_root,
+        dataset=spec['dataset'],
+        compact_version=spec['version'].replace('-', ''),
+        version=spec['version']
+    )
+
+
+def make_quarantine_path(output_root, spec):
+    return '{root}/quarantine/dataset={dataset}/v={version}/p=json'.format(
+        root=output_root,
+        dataset=spec['dataset'],
+        version=spec['version']
+    )
+
+
+def read_with_pinned_schema(spark, source_path, spec, push_down_predicate=None):
+    """Reads JSON with the pinned schema, skipping the inference pass over the whole dataset."""
+    df = spark.read \
+        .schema(spec['pinned_schema']) \
+        .option('mode', 'PERMISSIVE') \
+        .option('columnNameOfCorruptRecord', CORRUPT_RECORD_COLUMN) \
+        .json(source_path)
+    return df.filter(push_down_predicate) if push_down_predicate else df
+
+
+def get_table_location(database_name, table_name):
+    table = boto3.client('glue').get_table(DatabaseName=database_name, Name=table_name)
+    return table['Table']['StorageDescriptor']['Location']
+
+
+def make_catalog_reader(glue_context, database_name):
+    def read(spec, push_down_predicate=None, bookmarked=False):
+        # Bookmarked reads only need the partitions they touch and stay on DynamicFrames, which track bookmarks
+        if spec.get('pinned_schema') and not bookmarked:
+            source_path = spec.get('source_path') or get_table_location(database_name, spec['source_table'])
+            return read_with_pinned_schema(glue_context.spark_session, source_path, spec, push_down_predicate)
+        options = {}
+        if push_down_predicate:
+            options['push_down_predicate'] = push_down_predicate
+        if bookmarked:
+            # Job bookmarks are tracked per transformation context
+            options['transformation_ctx'] = spec['source_table']
+        return glue_context.create_dynamic_frame.from_catalog(
+            database=database_name,
+            table_name=spec['source_table'],
+            **options
+        ).toDF()
+    return read
+
+
+def make_local_reader(spark, source_root):
+    def read(spec, push_down_predicate=None, bookmarked=False):
+        source_path = spec.get('source_path') or '{}/{}'.format(source_root, spec['source_table'])
+        if spec.get('pinned_schema'):
+            return read_with_pinned_schema(spark, source_path, spec, push_down_predicate)
+        df = spark.read.json(source_path)
+        return df.filter(push_down_predicate) if push_down_predicate else df
+    return read
+
+
+def make_catalog_partition_lister(spark, database_name):
+    def list_partitions(spec):
+        if spec.get('source_path'):
+            return list_source_partitions(spark, spec['source_path'], spec['partition_keys'])
+        # Partition values come from the catalog, no data or S3 listing is touched
+        glue = boto3.client('glue')
+        table = glue.get_table(DatabaseName=database_name, Name=spec['source_table'])['Table']
+        names = [key['Name'] for key in table['PartitionKeys']]
+        positions = [names.index(key) for key in spec['partition_keys']]
+        partitions = set()
+        paginator = glue.get_paginator('get_partitions')
+        for page in paginator.paginate(DatabaseName=database_name, TableName=spec['source_table']):
+            for partition in page['Partitions']:
+                partitions.add(tuple(partition['Values'][position] for position in positions))
+        return partitions
+    return list_partitions
+
+
+def make_local_partition_lister(spark, source_root):
+    def list_partitions(spec):
+        source_path = spec.get('source_path') or '{}/{}'.format(source_root, spec['source_table'])
+        return list_source_partitions(spark, source_path, spec['partition_keys'])
+    return list_partitions
+
+
+def get_filesystem(spark, path):
+    """Returns the Hadoop FileSystem and Path for path, which works for both s3:// and local paths."""
+    hadoop_path = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()), hadoop_path
+
+
+def list_written_partitions(spark, target_path, partition_keys):
+    """Returns the partition value tuples already present under target_path, e.g. {('2017-06-01',)}."""
+    fs, root = get_filesystem(spark, target_path)
+    if not fs.exists(root):
+        return set()
+    partitions = {()}
+    paths = {(): root}
+    for key in partition_keys:
+        prefix = key + '='
+        next_paths = {}
+        for values in partitions:
+            for status in fs.listStatus(paths[values]):
+                name = status.getPath().getName()
+                if status.isDirectory() and name.startswith(prefix):
+                    next_paths[values + (name[len(prefix):],)] = status.getPath()
+        partitions = set(next_paths)
+        paths = next_paths
+    return partitions
+
+
+def list_source_partitions(spark, source_path, partition_keys):
+    """
+    Returns the partition value tuples of the key=value directories below source_path.
+
+    Submissions nest dt below other partition directories such as dataset=, v= and p=, so every key=value level is
+    descended until all partition_keys are known. Only directories are listed, never the data files.
+    """
+    fs, root = get_filesystem(spark, source_path)
+    if not fs.exists(root):
+        return set()
+    partitions = set()
+    pending = [(root, {})]
+    while pending:
+        path, values = pending.pop()
+        for status in fs.listStatus(path):
+            name = status.getPath().getName()
+            if not status.isDirectory() or '=' not in name or name.startswith(('_', '.')):
+                continue
+            key, _, value = name.partition('=')
+            found = dict(values, **{key: value})
+            if all(partition_key in found for partition_key in partition_keys):
+                partitions.add(tuple(found[partition_key] for partition_key in partition_keys))
+            else:
+                pending.append((status.getPath(), found))
+    return partitions
+
+
+def make_partition_predicate(partition_keys, partitions):
+    return ' OR '.join(
+        '({})'.format(' AND '.join("{} = '{}'".format(key, value) for key, value in zip(partition_keys, values)))
+        for values in sorted(partitions)
+    )
+
+
+def select_incremental_partitions(spark, read, list_partitions, spec, target_path, bookmarks_enabled):
+    """
+    Returns the partition value tuples an incremental run has to (re)write.
+
+    With job bookmarks enabled the bookmarked read only returns files added since the last committed run, so every
+    partition it touches has changed. Without bookmarks the source partitions are listed from the catalog or the
+    source directories, without reading any data, and only the ones missing from the curated output are converted.
+    """
+    keys = spec['partition_keys']
+    if bookmarks_enabled:
+        return {tuple(row) for row in read(spec, bookmarked=True).select(*keys).distinct().collect()}
+    return list_partitions(spec) - list_written_partitions(spark, target_path, keys)
+
+
+def estimate_record_bytes(spark, df, target_path, spec):
+    """
+    Measures the average on-disk size of a record by writing a sample as Parquet with the dataset's compression.
+
+    This is the same measure compact_dataset sizes files by. A sample file compresses slightly worse than a full
+    one, so files come out at or a little below the target size. The sample is collected with take, which scans
+    input partitions incrementally until it has enough rows, whereas a limit inside a write runs on every input
+    partition and would read the whole source once more before the real write.
+    """
+    sample_path = '{}/_sizing'.format(target_path)
+    df = df.drop(*spec['partition_keys'])
+    rows = df.take(RECORD_SIZE_SAMPLE_ROWS)
+    if not rows:
+        return 1
+    spark.createDataFrame(rows, df.schema).coalesce(1).write \
+        .option('compression', spec['compression']) \
+        .parquet(sample_path, mode='overwrite')
+    fs, sample = get_filesystem(spark, sample_path)
+    try:
+        sample_bytes = fs.getContentSummary(sample).getLength()
+    finally:
+        fs.delete(sample, True)
+    return max(1, sample_bytes // len(rows))
+
+
+def write_parquet(spark, df, target_path, spec, overwrite_mode='static'):
+    """
+    Writes df as Parquet sized towards spec['target_file_size_mb'] per file.
+
+    Rows are repartitioned by the partition keys so each output partition is written by a single task, which then
+    splits it into files of at most maxRecordsPerFile records instead of one small file per input split.
+    """
+    keys = spec['partition_keys']
+    record_bytes = estimate_record_bytes(spark, df, target_path, spec)
+    records_per_file = max(1, spec['target_file_size_mb'] * 1024 ** 2 // record_bytes)
+    if keys:
+        df = df.repartition(*keys)
+    df.write \
+        .option('partitionOverwriteMode', overwrite_mode) \
+        .option('maxRecordsPerFile', records_per_file) \
+        .option('compression', spec['compression']) \
+        .partitionBy(*keys) \
+        .parquet(target_path, mode='overwrite')
+
+
+def convert_dataset(spark, read, list_partitions, spec, output_root, incremental=False, bookmarks_enabled=False):
+    # Every thread gets its own scheduler pool so concurrent conversions share the cluster fairly
+    spark.sparkContext.setLocalProperty('spark.scheduler.pool', spec['source_table'])
+    target_path = make_target_path(output_root, spec)
+    if incremental:
+        partitions = select_incremental_partitions(spark, read, list_partitions, spec, target_path,
+                                                   bookmarks_enabled)
+        if not partitions:
+            print('No new partitions for {}'.format(spec['source_table']))
+            return target_path
+        print('Converting {} partitions of {} to {}'.format(len(partitions), spec['source_table'], target_path))
+        # Changed partitions are re-read in full so the overwrite does not drop rows from earlier files
+        df = read(spec, push_down_predicate=make_partition_predicate(spec['partition_keys'], partitions))
+        overwrite_mode = 'dynamic'
+    else:
+        print('Converting {} to {}'.format(spec['source_table'], target_path))
+        df = read(spec)
+        overwrite_mode = 'static'
+    if CORRUPT_RECORD_COLUMN in df.columns:
+        df = quarantine_corrupt_records(df, make_quarantine_path(output_root, spec), spec)
+    write_parquet(spark, df.drop(*PATH_COLUMNS), target_path, spec, overwrite_mode)
+    return target_path
+
+
+def quarantine_corrupt_records(df, quarantine_path, spec):
+    """
+    Appends the raw JSON of rows that failed the pinned schema to quarantine_path and returns the remaining rows.
+    """
+    # Spark refuses queries on the corrupt record column of an uncached JSON read
+    df = df.cache()
+    corrupt = df.filter(col(CORRUPT_RECORD_COLUMN).isNotNull())
+    corrupt_count = corrupt.count()
+    if corrupt_count:
+        print('Quarantining {} records of {} to {}'.format(corrupt_count, spec['source_table'], quarantine_path))
+        corrupt.select(CORRUPT_RECORD_COLUMN, *spec['partition_keys']).write \
+            .partitionBy(*spec['partition_keys']) \
+            .text(quarantine_path, mode='append')
+    return df.filter(col(CORRUPT_RECORD_COLUMN).isNull()).drop(CORRUPT_RECORD_COLUMN)
+
+
+def infer_schema(spark, read, spec):
+    """Runs schema inference once and writes the result as the pinned schema of the dataset."""
+    df = read(dict(spec, pinned_schema=None))
+    schema = df.drop(*PATH_COLUMNS).drop(*spec['partition_keys']).schema
+    os.makedirs(os.path.dirname(spec['schema_path']), exist_ok=True)
+    with open(spec['schema_path'], 'w') as schema_file:
+        json.dump(schema.jsonValue(), schema_file, indent=2, sort_keys=True)
+    print('Pinned schema of {} written to {}:'.format(spec['source_table'], spec['schema_path']))
+    print(schema.json())
+    return spec['schema_path']
+
+
+def rename_or_raise(fs, source, destination):
+    # FileSystem.rename reports most failures by returning False instead of raising
+    if not fs.rename(source, destination):
+        raise IOError('Could not rename {} to {}'.format(source, destination))
+
+
+def make_partition_relative_path(partition_keys, values):
+    return '/'.join('{}={}'.format(key, value) for key, value in zip(partition_keys, values))
+
+
+def recover_interrupted_compaction(spark, target_path, partition_keys):
+    """
+    Finishes the partition swaps of a compaction run that died between moving a partition aside and deleting it.
+
+    A partition that is missing from target_path gets its staged copy moved in, which is complete since it is
+    only moved aside once the staged copy is written, or its replaced copy back when there is no staged copy.
+    """
+    replaced_root = '{}/_compaction/replaced'.format(target_path)
+    for values in list_written_partitions(spark, replaced_root, partition_keys):
+        relative_path = make_partition_relative_path(partition_keys, values)
+        fs, partition = get_filesystem(spark, '{}/{}'.format(target_path, relative_path))
+        _, staged = get_filesystem(spark, '{}/_compaction/staged/{}'.format(target_path, relative_path))
+        _, replaced = get_filesystem(spark, '{}/{}'.format(replaced_root, relative_path))
+        if not fs.exists(partition):
+            print('Recovering interrupted compaction of {}'.format(partition))
+            rename_or_raise(fs, staged if fs.exists(staged) else replaced, partition)
+        fs.delete(replaced, True)
+
+
+def compact_dataset(spark, spec, output_root):
+    """
+    Rewrites every existing partition of a curated dataset into files of about spec['target_file_size_mb'].
+
+    Each partition is written to a hidden staging directory first, since Spark cannot overwrite a path it is
+    reading from. The live partition is then moved aside, the staged copy moved in, and the old copy deleted only
+    once the new one is in place, so a failed rename or an interrupted run never leaves the partition without data.
+    """
+    spark.sparkContext.setLocalProperty('spark.scheduler.pool', spec['source_table'])
+    target_path = make_target_path(output_root, spec)
+    keys = spec['partition_keys']
+    target_bytes = spec['target_file_size_mb'] * 1024 ** 2
+    recover_interrupted_compaction(spark, target_path, keys)
+    for values in sorted(list_written_partitions(spark, target_path, keys)):
+        relative_path = make_partition_relative_path(keys, values)
+        partition_path = '{}/{}'.format(target_path, relative_path)
+        staging_path = '{}/_compaction/staged/{}'.format(target_path, relative_path)
+        fs, partition = get_filesystem(spark, partition_path)
+        _, staging = get_filesystem(spark, staging_path)
+        _, replaced = get_filesystem(spark, '{}/_compaction/replaced/{}'.format(target_path, relative_path))
+        file_count = max(1, math.ceil(fs.getContentSummary(partition).getLength() / target_bytes))
+        print('Compacting {} into {} files'.format(partition_path, file_count))
+        spark.read.parquet(partition_path).repartition(file_count).write \
+            .option('compression', spec['compression']) \
+            .parquet(staging_path, mode='overwrite')
+        fs.mkdirs(replaced.getParent())
+        rename_or_raise(fs, partition, replaced)
+        try:
+            rename_or_raise(fs, staging, partition)
+        except Exception:
+            rename_or_raise(fs, replaced, partition)
+            raise
+        fs.delete(replaced, True)
+    # Every partition has been swapped in, only empty directories are left
+    fs, staging_root = get_filesystem(spark, '{}/_compaction'.format(target_path))
+    fs.delete(staging_root, True)
+    return target_path
+
+
+def run_for_datasets(task, datasets, max_concurrency):
+    """
+    Runs task(spec) for all datasets concurrently within one Spark session.
+
+    Spark schedules jobs submitted from different threads in parallel, so adding a dataset adds work to the
+    cluster rather than serial wall-clock time. All datasets are attempted before any failure is raised.
+    """
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        # Kept as pairs, several specs may read the same source table, e.g. to write two versions
+        futures = [(spec, executor.submit(task, spec)) for spec in datasets]
+    failed = []
+    for spec, future in futures:
+        if future.exception() is not None:
+            name = '{} ({} v={})'.format(spec['source_table'], spec['dataset'], spec['version'])
+            print('Failed to process {}: {}'.format(name, future.exception()))
+            failed.append(name)
+    if failed:
+        raise RuntimeError('Failed to process datasets: {}'.format(', '.join(failed)))
+
+
+def convert_datasets(spark, read, list_partitions, datasets, output_root, max_concurrency, incremental=False,
+                     bookmarks_enabled=False):
+    def convert(spec):
+        return convert_dataset(spark, read, list_partitions, spec, output_root, incremental, bookmarks_enabled)
+    run_for_datasets(convert, datasets, max_concurrency)
+
+
+def infer_schemas(spark, read, datasets, max_concurrency):
+    def infer(spec):
+        return infer_schema(spark, read, spec)
+    run_for_datasets(infer, datasets, max_concurrency)
+
+
+def compact_datasets(spark, datasets, output_root, max_concurrency):
+    def compact(spec):
+        return compact_dataset(spark, spec, output_root)
+    run_for_datasets(compact, datasets, max_concurrency)
+
+
+def main(argv):
+    conf = SparkConf().set('spark.scheduler.mode', 'FAIR')
+    sc = SparkContext.getOrCreate(conf=conf)
+    job = None
+    if GlueContext is not None:
+        args = resolve_glue_options(argv)
+        glue_context = GlueContext(sc)
+        spark = glue_context.spark_session
+        job = Job(glue_context)
+        job.init(args['JOB_NAME'], args)
+        read = make_catalog_reader(glue_context, args['datalake_curated_datasets_database_name'])
+        list_partitions = make_catalog_partition_lister(spark, args['datalake_curated_datasets_database_name'])
+        output_root = 's3://{}'.format(args['datalake_curated_datasets_bucket_name'])
+    else:
+        args = resolve_local_options(argv)
+        spark = SparkSession(sc)
+        read = make_local_reader(spark, args['source_root'])
+        list_partitions = make_local_partition_lister(spark, args['source_root'])
+        output_root = args['output_root']
+
+    # Partition values such as dt and v stay strings, matching the catalog and the pinned schemas
+    spark.conf.set('spark.sql.sources.partitionColumnTypeInference.enabled', 'false')
+    datasets = load_datasets(args)
+    max_concurrency = max(1, int(args.get('max_concurrency', len(datasets))))
+    mode = args.get('mode', MODE_CONVERT)
+    if mode == MODE_COMPACT:
+        compact_datasets(spark, datasets, output_root, max_concurrency)
+    elif mode == MODE_INFER_SCHEMAS:
+        infer_schemas(spark, read, datasets, max_concurrency)
+    else:
+        incremental = args.get('incremental', 'false').lower() == 'true'
+        bookmarks_enabled = 'job-bookmark-enable' in argv
+        convert_datasets(spark, read, list_partitions, datasets, output_root, max_concurrency, incremental,
+                         bookmarks_enabled)
+
+    if job is not None:
+        job.commit()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,389 @@
+import argparse
+import hashlib
+import json
+import sys
+
+from elasticsearch import Elasticsearch, RequestsHttpConnection, helpers
+from pyspark import SparkConf
+from pyspark.context import SparkContext
+from pyspark.sql import SparkSession, Window
+from pyspark.sql.functions import (
+    col, collect_set, concat, concat_ws, count, date_format, date_trunc, expr, lit, row_number, sum as sum_
+)
+
+try:
+    from awsglue.context import GlueContext
+    from awsglue.job import Job
+    from awsglue.utils import getResolvedOptions
+except ImportError:
+    # Running outside of AWS Glue, the job falls back to a plain PySpark session and an unsigned Elasticsearch client
+    GlueContext = None
+
+try:
+    import boto3
+    from aws_requests_auth.aws_auth import AWSRequestsAuth
+    signing_import_error = None
+except ImportError as e:
+    # Only the signed client of Glue runs needs these, make_signed_elasticsearch_client reports them missing
+    signing_import_error = e
+
+## @params: [JOB_NAME, datalake_curated_datasets_bucket_name, elasticsearch_endpoint]
+REQUIRED_ARGS = [
+    'JOB_NAME',
+    'datalake_curated_datasets_bucket_name',
+    'elasticsearch_endpoint'
+]
+## @params (optional): [source, bucket, top_sku_limit, incremental]
+OPTIONAL_ARGS = ['source', 'bucket', 'top_sku_limit', 'incremental']
+REVENUE_BY_STATE_INDEX = 'revenue_by_state'
+TOP_SKU_INDEX = 'top_sku'
+ROLLUP_DOC_TYPE = 'rollup'
+# Time bucket of the summary documents, any date_trunc unit such as hour or day
+DEFAULT_BUCKET = 'hour'
+# SKUs kept per time bucket in the top_sku index
+DEFAULT_TOP_SKU_LIMIT = 20
+BULK_CHUNK_SIZE = 500
+# Time buckets per delete by query, keeps the terms query of a large recompute small
+DELETE_CHUNK_SIZE = 1000
+# ISO 8601 with offset, rendered by Spark in the session time zone, which main sets to UTC
+TIMESTAMP_FORMAT = "yyyy-MM-dd'T'HH:mm:ssXXX"
+
+# Curated dataset the rollups are computed from when the job is started without --source. The columns map the
+# fields of the summary documents to Spark SQL expressions over the curated rows.
+DEFAULT_SOURCE = {
+    'dataset': 'orders',
+    'version': '2017-12-06',
+    'partition_keys': ['dt'],
+    'columns': {
+        'timestamp': 'order_date',
+        'state': 'state',
+        'sku': 'sku',
+        'revenue': 'amount',
+    },
+}
+# Text with a keyword sub-field, as dynamic mapping would create it; the visualizations split by state.keyword
+# and sku.keyword
+KEYWORD_TEXT_MAPPING = {'type': 'text', 'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}}}
+INDEX_MAPPINGS = {
+    REVENUE_BY_STATE_INDEX: {
+        'timestamp': {'type': 'date'},
+        'state': KEYWORD_TEXT_MAPPING,
+        'revenue': {'type': 'double'},
+        'orders': {'type': 'long'},
+    },
+    TOP_SKU_INDEX: {
+        'timestamp': {'type': 'date'},
+        'sku': KEYWORD_TEXT_MAPPING,
+        'sku_count': {'type': 'long'},
+        'rank': {'type': 'integer'},
+    },
+}
+
+
+def resolve_glue_options(argv):
+    args = getResolvedOptions(argv, REQUIRED_ARGS)
+    for name in OPTIONAL_ARGS:
+        if '--{}'.format(name) in argv:
+            args.update(getResolvedOptions(argv, [name]))
+    return args
+
+
+def resolve_local_options(argv):
+    parser = argparse.ArgumentParser(description='Rollup indices job, local PySpark mode')
+    parser.add_argument('--JOB_NAME', default='rollup-indices-local')
+    parser.add_argument('--datalake_curated_datasets_bucket_name', default='')
+    parser.add_argument('--elasticsearch_endpoint', default='http://localhost:9200')
+    parser.add_argument('--source')
+    parser.add_argument('--bucket')
+    parser.add_argument('--top_sku_limit')
+    parser.add_argument('--incremental')
+    parser.add_argument('--curated_root', required=True, help='Directory holding the curated Parquet datasets')
+    return {key: value for key, value in vars(parser.parse_args(argv[1:])).items() if value is not None}
+
+
+def load_source(args):
+    source = json.loads(args['source']) if 'source' in args else DEFAULT_SOURCE
+    source.setdefault('partition_keys', ['dt'])
+    source['columns'] = dict(DEFAULT_SOURCE['columns'], **source.get('columns', {}))
+    return source
+
+
+def make_curated_path(curated_root, source):
+    # Same layout as make_target_path of curated-datasets-job.py
+    if 'target_path' in source:
+        return '{}/{}'.format(curated_root, source['target_path'])
+    return '{root}/{dataset}_{compact_version}_parquet/dataset={dataset}/v={version}/p=parquet'.format(
+        root=curated_root,
+        dataset=source['dataset'],
+        compact_version=source['version'].replace('-', ''),
+        version=source['version']
+    )
+
+
+def make_state_path(curated_root, source):
+    return '{root}/_rollups/dataset={dataset}/v={version}/state.json'.format(
+        root=curated_root,
+        dataset=source['dataset'],
+        version=source['version']
+    )
+
+
+def make_signed_elasticsearch_client(elasticsearch_endpoint):
+    if signing_import_error is not None:
+        raise ImportError('Signing Elasticsearch requests needs boto3 and aws_requests_auth, add aws-requests-auth '
+                          'to the job with --additional-python-modules: {}'.format(signing_import_error))
+    session = boto3.Session()
+    credentials = session.get_credentials().get_frozen_credentials()
+    awsauth = AWSRequestsAuth(
+        aws_access_key=credentials.access_key,
+        aws_secret_access_key=credentials.secret_key,
+        aws_token=credentials.token,
+        aws_host=elasticsearch_endpoint,
+        aws_region=session.region_name,
+        aws_service='es'
+    )
+    return Elasticsearch(
+        hosts=['{0}:443'.format(elasticsearch_endpoint)],
+        use_ssl=True,
+        connection_class=RequestsHttpConnection,
+        http_auth=awsauth
+    )
+
+
+def get_filesystem(spark, path):
+    """Returns the Hadoop FileSystem and Path for path, which works for both s3:// and local paths."""
+    hadoop_path = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()), hadoop_path
+
+
+def list_partition_versions(spark, curated_path):
+    """
+    Returns the latest file modification time of every partition below curated_path, e.g. {'dt=2017-06-01': 1512...}.
+
+    A partition rewritten by the curated-datasets job, or by its compaction, gets a newer version.
+    """
+    fs, root = get_filesystem(spark, curated_path)
+    if not fs.exists(root):
+        return {}
+    root_uri = fs.makeQualified(root).toUri().getPath().rstrip('/') + '/'
+    versions = {}
+    files = fs.listFiles(root, True)
+    while files.hasNext():
+        status = files.next()
+        file_path = status.getPath()
+        # Skips _SUCCESS markers, .crc files and the _compaction staging directory
+        relative_path = file_path.toUri().getPath()[len(root_uri):]
+        if any(part.startswith(('_', '.')) for part in relative_path.split('/')):
+            continue
+        partition = relative_path.rpartition('/')[0]
+        versions[partition] = max(versions.get(partition, 0), status.getModificationTime())
+    return versions
+
+
+def load_state(spark, state_path):
+    """Returns the state of the last run: {partition: {'version': modification time, 'buckets': [timestamp, ...]}}."""
+    fs, path = get_filesystem(spark, state_path)
+    if not fs.exists(path):
+        return {}
+    return json.loads(''.join(spark.sparkContext.textFile(state_path).collect()))
+
+
+def save_state(spark, state_path, state):
+    fs, path = get_filesystem(spark, state_path)
+    output = fs.create(path, True)
+    try:
+        output.write(bytearray(json.dumps(state, indent=2, sort_keys=True).encode('utf-8')))
+    finally:
+        output.close()
+
+
+def read_rollup_input(spark, curated_path, source, bucket, partitions=None):
+    """
+    Reads the curated rows, optionally only the given partitions, as timestamp, bucket, state, sku, revenue and
+    partition, the partition directory relative to curated_path as list_partition_versions names it.
+
+    The bucket is formatted as a UTC timestamp with offset inside Spark. Timestamps collected to the driver would
+    be converted to naive datetimes in the driver's local time zone.
+    """
+    if partitions:
+        df = spark.read.option('basePath', curated_path).parquet(
+            *['{}/{}'.format(curated_path, partition) for partition in partitions]
+        )
+    else:
+        df = spark.read.parquet(curated_path)
+    columns = source['columns']
+    df = df.select(
+        expr(columns['timestamp']).cast('timestamp').alias('timestamp'),
+        expr(columns['state']).cast('string').alias('state'),
+        expr(columns['sku']).cast('string').alias('sku'),
+        expr(columns['revenue']).cast('double').alias('revenue'),
+        concat_ws('/', *[concat(lit(key + '='), col(key)) for key in source['partition_keys']]).alias('partition'),
+    ).filter(col('timestamp').isNotNull())
+    return df.withColumn('bucket', date_format(date_trunc(bucket, col('timestamp')), TIMESTAMP_FORMAT))
+
+
+def rollup_revenue_by_state(df):
+    return df.filter(col('state').isNotNull()) \
+        .groupBy('bucket', 'state') \
+        .agg(sum_('revenue').alias('revenue'), count('*').alias('orders')) \
+        .withColumnRenamed('bucket', 'timestamp')
+
+
+def rollup_top_sku(df, limit):
+    """Counts the rows per SKU and time bucket and keeps the limit most frequent SKUs of each bucket."""
+    ranking = Window.partitionBy('bucket').orderBy(col('sku_count').desc(), col('sku'))
+    return df.filter(col('sku').isNotNull()) \
+        .groupBy('bucket', 'sku') \
+        .agg(count('*').alias('sku_count')) \
+        .withColumn('rank', row_number().over(ranking)) \
+        .filter(col('rank') <= limit) \
+        .withColumnRenamed('bucket', 'timestamp')
+
+
+def make_rollup_document_id(document, id_fields):
+    key = '/'.join(str(document[field]) for field in id_fields)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def make_index_actions(df, index, id_fields):
+    """
+    Streams the summary rows to the driver as bulk index actions.
+
+    Ids are derived from the time bucket and the group, so a redelivered load overwrites its documents. Documents of
+    a recomputed bucket whose group no longer occurs are removed by delete_buckets before the load.
+    """
+    for row in df.toLocalIterator():
+        document = row.asDict()
+        yield {
+            '_op_type': 'index',
+            '_index': index,
+            '_type': ROLLUP_DOC_TYPE,
+            '_id': make_rollup_document_id(document, id_fields),
+            '_source': document
+        }
+
+
+def ensure_rollup_indices(es_client):
+    for index, properties in INDEX_MAPPINGS.items():
+        if not es_client.indices.exists(index=index):
+            es_client.indices.create(index=index, body={'mappings': {ROLLUP_DOC_TYPE: {'properties': properties}}})
+
+
+def delete_buckets(es_client, index, buckets):
+    """Deletes all documents of the given time buckets, so a recomputed bucket keeps no state or rank it lost."""
+    buckets = sorted(buckets)
+    deleted = 0
+    for start in range(0, len(buckets), DELETE_CHUNK_SIZE):
+        response = es_client.delete_by_query(
+            index=index,
+            doc_type=ROLLUP_DOC_TYPE,
+            body={'query': {'terms': {'timestamp': buckets[start:start + DELETE_CHUNK_SIZE]}}},
+            conflicts='proceed'
+        )
+        deleted += response['deleted']
+    print('Deleted {} documents of {} recomputed buckets from {}'.format(deleted, len(buckets), index))
+    return deleted
+
+
+def load_rollup(es_client, df, index, id_fields):
+    indexed, _ = helpers.bulk(es_client, make_index_actions(df, index, id_fields), chunk_size=BULK_CHUNK_SIZE)
+    print('Indexed {} documents into {}'.format(indexed, index))
+    return indexed
+
+
+def run_rollups(spark, es_client, source, curated_root, bucket, top_sku_limit, incremental=False):
+    """
+    Computes the revenue_by_state and top_sku summaries of the curated source and loads them into Elasticsearch.
+
+    Incremental runs only recompute the time buckets that occur in partitions added or rewritten since the last run.
+    Rows of one bucket can be spread over several partitions, so the state records the buckets of every partition
+    and a bucket is recomputed from exactly the partitions holding it; all other partitions are not read. The
+    documents of recomputed buckets are deleted before the new ones are loaded. The state is saved after the
+    documents are loaded, so a failed run is repeated.
+    """
+    curated_path = make_curated_path(curated_root, source)
+    state_path = make_state_path(curated_root, source)
+    partition_versions = list_partition_versions(spark, curated_path)
+    state = load_state(spark, state_path) if incremental else {}
+    # Buckets of deleted partitions are recomputed from the partitions still holding them
+    removed_buckets = {
+        timestamp for partition, entry in state.items() if partition not in partition_versions
+        for timestamp in entry['buckets']
+    }
+    state = {partition: entry for partition, entry in state.items() if partition in partition_versions}
+    changed = sorted(
+        partition for partition, version in partition_versions.items()
+        if version > state.get(partition, {}).get('version', 0)
+    )
+    if not changed and not removed_buckets:
+        print('No new partitions in {}'.format(curated_path))
+        return
+
+    changed_df = read_rollup_input(spark, curated_path, source, bucket, changed)
+    changed_buckets = {
+        row['partition']: sorted(row['buckets'])
+        for row in changed_df.groupBy('partition').agg(collect_set('bucket').alias('buckets')).collect()
+    }
+    # A rewritten partition may have lost rows, the buckets it held before are recomputed as well
+    buckets = removed_buckets.union(
+        timestamp for partition in changed for timestamp in state.get(partition, {}).get('buckets', [])
+    )
+    for partition in changed:
+        state[partition] = {'version': partition_versions[partition], 'buckets': changed_buckets.get(partition, [])}
+    buckets.update(timestamp for partition in changed for timestamp in state[partition]['buckets'])
+    partitions = sorted(
+        partition for partition, entry in state.items() if buckets.intersection(entry['buckets'])
+    )
+    print('Recomputing {} {} buckets of {} changed partitions from {} of {} partitions'
+          .format(len(buckets), bucket, len(changed), len(partitions), len(partition_versions)))
+    ensure_rollup_indices(es_client)
+    if buckets:
+        for index in INDEX_MAPPINGS:
+            delete_buckets(es_client, index, buckets)
+    if partitions:
+        df = read_rollup_input(spark, curated_path, source, bucket, partitions) \
+            .filter(col('bucket').isin(sorted(buckets))) \
+            .cache()
+        load_rollup(es_client, rollup_revenue_by_state(df), REVENUE_BY_STATE_INDEX, ['timestamp', 'state'])
+        load_rollup(es_client, rollup_top_sku(df, top_sku_limit), TOP_SKU_INDEX, ['timestamp', 'rank'])
+        df.unpersist()
+    save_state(spark, state_path, state)
+
+
+def main(argv):
+    sc = SparkContext.getOrCreate(conf=SparkConf())
+    job = None
+    if GlueContext is not None:
+        args = resolve_glue_options(argv)
+        glue_context = GlueContext(sc)
+        spark = glue_context.spark_session
+        job = Job(glue_context)
+        job.init(args['JOB_NAME'], args)
+        curated_root = 's3://{}'.format(args['datalake_curated_datasets_bucket_name'])
+        es_client = make_signed_elasticsearch_client(args['elasticsearch_endpoint'])
+    else:
+        args = resolve_local_options(argv)
+        spark = SparkSession(sc)
+        curated_root = args['curated_root']
+        es_client = Elasticsearch(hosts=[args['elasticsearch_endpoint']])
+
+    # Partition values such as dt stay strings, matching the curated-datasets job
+    spark.conf.set('spark.sql.sources.partitionColumnTypeInference.enabled', 'false')
+    # Buckets are computed and indexed in UTC, which is how Elasticsearch reads timestamps without an offset
+    spark.conf.set('spark.sql.session.timeZone', 'UTC')
+    run_rollups(
+        spark,
+        es_client,
+        load_source(args),
+        curated_root,
+        args.get('bucket', DEFAULT_BUCKET),
+        int(args.get('top_sku_limit', DEFAULT_TOP_SKU_LIMIT)),
+        args.get('incremental', 'true').lower() == 'true'
+    )
+
+    if job is not None:
+        job.commit()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
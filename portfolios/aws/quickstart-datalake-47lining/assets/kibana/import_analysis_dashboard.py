@@ -1,11 +1,19 @@
 import argparse
+import hashlib
 import json
 import os
+import time
+import urllib.error
 import urllib.request
 
 from root import PROJECT_DIR
 
 KIBANA_TEMPLATE_URL = 'https://{es_endpoint}/.kibana/{type}/{id}/'
+KIBANA_MGET_URL = 'https://{es_endpoint}/.kibana/_mget'
+BULK_URL = 'https://{es_endpoint}/_bulk'
+KIBANA_INDEX = '.kibana'
+MAX_ATTEMPTS = 4
+RETRY_BACKOFF_SECONDS = 1
 KIBANA_DASHBOARD_PATH = os.path.join(PROJECT_DIR, 'kibana/kibana_analysis_visualizations.json')
 INDEX_TO_TIME_FIELD = {
     'revenue_by_state': 'timestamp',
@@ -23,6 +31,77 @@ def send_put_request(url, data):
     urllib.request.urlopen(request)
 
 
+def send_request(url, body, content_type, method='POST'):
+    """Sends a request and returns the decoded JSON response, retrying throttling and server errors."""
+    request = urllib.request.Request(
+        url,
+        data=body.encode('utf8'),
+        headers={'content-type': content_type},
+        method=method
+    )
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read().decode('utf8'))
+        except urllib.error.HTTPError as e:
+            if (e.code != 429 and e.code < 500) or attempt == MAX_ATTEMPTS:
+                raise
+        except urllib.error.URLError:
+            if attempt == MAX_ATTEMPTS:
+                raise
+        time.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+
+def content_hash(source):
+    return hashlib.sha256(json.dumps(source, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def fetch_saved_object_hashes(elasticsearch_endpoint, saved_objects):
+    docs = [{'_type': type, '_id': id} for type, id, _ in saved_objects]
+    try:
+        response = send_request(
+            KIBANA_MGET_URL.format(es_endpoint=elasticsearch_endpoint),
+            json.dumps({'docs': docs}),
+            content_type='application/json'
+        )
+    except urllib.error.HTTPError as e:
+        # .kibana index does not exist yet, everything is new
+        if e.code == 404:
+            return {}
+        raise
+    return {
+        (doc['_type'], doc['_id']): content_hash(doc['_source'])
+        for doc in response['docs'] if doc.get('found')
+    }
+
+
+def bulk_import_saved_objects(elasticsearch_endpoint, saved_objects):
+    """
+    Imports (type, id, source) saved objects with a single _bulk request.
+
+    Objects whose stored content is identical to the new content are skipped, so re-imports
+    only write what changed.
+    """
+    existing_hashes = fetch_saved_object_hashes(elasticsearch_endpoint, saved_objects)
+    lines = []
+    for type, id, source in saved_objects:
+        if existing_hashes.get((type, id)) == content_hash(source):
+            continue
+        lines.append(json.dumps({'index': {'_index': KIBANA_INDEX, '_type': type, '_id': id}}))
+        lines.append(json.dumps(source))
+    print('Importing {} of {} saved objects'.format(len(lines) // 2, len(saved_objects)))
+    if not lines:
+        return
+    response = send_request(
+        BULK_URL.format(es_endpoint=elasticsearch_endpoint),
+        '\n'.join(lines) + '\n',
+        content_type='application/x-ndjson'
+    )
+    if response['errors']:
+        failed = [item['index'] for item in response['items'] if 'error' in item['index']]
+        raise RuntimeError('Failed to import saved objects: {}'.format(failed))
+
+
 def send_kibana_put(elasticsearch_endpoint, type, id, data):
     kibana_url = KIBANA_TEMPLATE_URL.format(es_endpoint=elasticsearch_endpoint, type=type, id=id)
     send_put_request(kibana_url, data)
@@ -49,13 +128,38 @@ def import_visualizations(elasticsearch_endpoint):
         )
 
 
+def make_index_pattern_objects():
+    return [
+        ('index-pattern', index_name, {'title': index_name, 'timeFieldName': time_field_name})
+        for index_name, time_field_name in INDEX_TO_TIME_FIELD.items()
+    ]
+
+
+def make_visualization_objects():
+    return [
+        (visualization_json['_type'], visualization_json['_id'], visualization_json['_source'])
+        for visualization_json in load_json(KIBANA_DASHBOARD_PATH)
+    ]
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Quick start App')
     parser.add_argument('--elasticsearch-endpoint', required=True, help='Elasticsearch endpoint')
+    parser.add_argument(
+        '--no-bulk',
+        action='store_true',
+        help='Import saved objects one PUT request at a time instead of a single bulk request'
+    )
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = parse_args()
-    register_kibana_indexes(args.elasticsearch_endpoint)
-    import_visualizations(args.elasticsearch_endpoint)
+    if args.no_bulk:
+        register_kibana_indexes(args.elasticsearch_endpoint)
+        import_visualizations(args.elasticsearch_endpoint)
+    else:
+        bulk_import_saved_objects(
+            args.elasticsearch_endpoint,
+            make_index_pattern_objects() + make_visualization_objects()
+        )
@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from elasticsearch import helpers
+
+from lambdas import (
+    ensure_metadata_index,
+    es_write_alias,
+    make_elasticsearch_client,
+    make_metadata_document,
+    make_metadata_document_id,
+)
+
+DEFAULT_CHECKPOINT_PATH = 'backfill_metadata_checkpoint.json'
+# Marks the objects stored directly in the bucket root, which are listed with a delimiter
+ROOT_PREFIX = ''
+# All rollover indices behind es_write_alias, op_type create only detects ids in the current write index
+ROLLOVER_INDEX_PATTERN = 'metadata-0*'
+
+s3 = boto3.client('s3')
+checkpoint_lock = threading.Lock()
+
+
+def load_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return {}
+    with open(checkpoint_path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def get_prefix_state(checkpoint, bucket, prefix):
+    with checkpoint_lock:
+        return checkpoint.setdefault(bucket, {}).setdefault(prefix, {})
+
+
+def save_checkpoint(checkpoint_path, checkpoint, state, **progress):
+    # Progress is recorded under the lock so other workers never dump a dict that is being changed
+    with checkpoint_lock:
+        state.update(progress)
+        tmp_path = checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, checkpoint_path)
+
+
+def list_top_level_prefixes(bucket):
+    prefixes = [ROOT_PREFIX]
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Delimiter='/'):
+        prefixes.extend(prefix['Prefix'] for prefix in page.get('CommonPrefixes', []))
+    return prefixes
+
+
+def make_listed_metadata_document(listed_object):
+    # list_objects_v2 already returns size, ETag and LastModified, only ContentType needs a HEAD and is left out
+    return make_metadata_document(listed_object['Key'], {
+        'ContentLength': listed_object['Size'],
+        'LastModified': listed_object['LastModified'],
+        'ContentType': None,
+        'ETag': listed_object['ETag'],
+    })
+
+
+def find_indexed_ids(es_client, document_ids):
+    """Returns the ids among document_ids that are indexed in any rollover index, not only the current one."""
+    response = es_client.search(
+        index=ROLLOVER_INDEX_PATTERN,
+        body={'query': {'ids': {'values': document_ids}}, '_source': False, 'size': len(document_ids)},
+    )
+    return {hit['_id'] for hit in response['hits']['hits']}
+
+
+def make_create_actions(bucket, documents):
+    for document_id, metadata in documents:
+        # op_type create keeps documents already indexed from S3 events, which carry the ContentType
+        yield {
+            '_op_type': 'create',
+            '_index': es_write_alias,
+            '_type': bucket,
+            '_id': document_id,
+            '_source': metadata
+        }
+
+
+def index_page(es_client, bucket, listed_objects):
+    """
+    Creates the documents of one listed page that are not indexed yet.
+
+    Ids found in an older rollover index are skipped up front, a create against the write alias would only
+    conflict with documents of the index the alias currently points to and duplicate everything rolled over.
+    """
+    documents = []
+    for listed_object in listed_objects:
+        metadata = make_listed_metadata_document(listed_object)
+        documents.append((make_metadata_document_id(bucket, metadata), metadata))
+    indexed_ids = find_indexed_ids(es_client, [document_id for document_id, _ in documents])
+    documents = [(document_id, metadata) for document_id, metadata in documents if document_id not in indexed_ids]
+    if not documents:
+        return 0
+    indexed, errors = helpers.bulk(es_client, make_create_actions(bucket, documents), raise_on_error=False)
+    failed = [error for error in errors if error['create'].get('status') != 409]
+    if failed:
+        raise RuntimeError('Failed to index {} objects of {}: {}'.format(len(failed), bucket, failed[:5]))
+    return indexed
+
+
+def backfill_prefix(es_client, bucket, prefix, checkpoint, checkpoint_path):
+    """
+    Lists one key prefix page by page and bulk-indexes each page, recording the last indexed key.
+
+    A restarted backfill continues after the recorded key of every prefix that did not finish.
+    """
+    state = get_prefix_state(checkpoint, bucket, prefix)
+    if state.get('done'):
+        return 0
+    list_kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if prefix == ROOT_PREFIX:
+        list_kwargs['Delimiter'] = '/'
+    if state.get('last_key'):
+        list_kwargs['StartAfter'] = state['last_key']
+
+    indexed = 0
+    for page in s3.get_paginator('list_objects_v2').paginate(**list_kwargs):
+        listed_objects = page.get('Contents', [])
+        if not listed_objects:
+            continue
+        indexed += index_page(es_client, bucket, listed_objects)
+        save_checkpoint(checkpoint_path, checkpoint, state, last_key=listed_objects[-1]['Key'])
+    save_checkpoint(checkpoint_path, checkpoint, state, done=True)
+    print('{}/{}: indexed {} objects'.format(bucket, prefix, indexed))
+    return indexed
+
+
+def backfill_bucket(es_client, bucket, checkpoint, checkpoint_path, workers):
+    prefixes = list_top_level_prefixes(bucket)
+    print('Backfilling {} prefixes of {}'.format(len(prefixes), bucket))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(backfill_prefix, es_client, bucket, prefix, checkpoint, checkpoint_path)
+            for prefix in prefixes
+        ]
+        return sum(future.result() for future in futures)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Backfill the metadata index with existing bucket contents')
+    parser.add_argument('--elasticsearch-endpoint', required=True, help='Elasticsearch endpoint')
+    parser.add_argument('--bucket', required=True, action='append', help='Bucket to backfill, may be repeated')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT_PATH, help='Checkpoint file used to resume')
+    parser.add_argument('--workers', type=int, default=8, help='Number of prefixes listed in parallel')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    es_client = make_elasticsearch_client(args.elasticsearch_endpoint)
+    ensure_metadata_index(es_client)
+    checkpoint = load_checkpoint(args.checkpoint)
+    for bucket in args.bucket:
+        total = backfill_bucket(es_client, bucket, checkpoint, args.checkpoint, args.workers)
+        print('{}: indexed {} objects'.format(bucket, total))
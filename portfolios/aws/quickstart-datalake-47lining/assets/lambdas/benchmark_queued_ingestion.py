@@ -0,0 +1,140 @@
+"""
+Local throughput harness for handle_queued_bucket_events.
+
+Builds SQS batches of S3 notifications the way the event source mapping delivers them, answers the object HEADs
+with synthetic responses and indexes either into an in-memory fake bulk client or into a local Elasticsearch, then
+reports documents per second. Every batch is delivered twice to show that redeliveries overwrite instead of
+duplicating documents.
+
+    python benchmark_queued_ingestion.py --batches 50 --batch-size 10
+    python benchmark_queued_ingestion.py --elasticsearch-endpoint http://localhost:9200
+"""
+import argparse
+import datetime
+import json
+import os
+import time
+import uuid
+
+# boto3 clients are created when lambdas is imported, no calls are made with them here
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from elasticsearch import Elasticsearch  # noqa: E402
+from elasticsearch.serializer import JSONSerializer  # noqa: E402
+
+import lambdas  # noqa: E402
+
+BUCKET = 'benchmark-submissions'
+
+
+class FakeIndices(object):
+
+    def put_template(self, **kwargs):
+        return {'acknowledged': True}
+
+    def exists_alias(self, **kwargs):
+        return True
+
+    def create(self, **kwargs):
+        return {'acknowledged': True}
+
+
+class FakeTransport(object):
+    # elasticsearch.helpers serializes the actions with the client's transport serializer
+    serializer = JSONSerializer()
+
+
+class FakeBulkClient(object):
+    """Accepts bulk requests like Elasticsearch and keeps the last document per index and id."""
+
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.indices = FakeIndices()
+        self.documents = {}
+        self.requests = 0
+
+    def bulk(self, body, **kwargs):
+        self.requests += 1
+        lines = body.splitlines() if isinstance(body, str) else body
+        items = []
+        for action_line, source_line in zip(lines[::2], lines[1::2]):
+            op_type, action = next(iter(json.loads(action_line).items()))
+            self.documents[(action['_index'], action['_id'])] = json.loads(source_line)
+            items.append({op_type: {'_index': action['_index'], '_id': action['_id'], 'status': 201}})
+        return {'took': 0, 'errors': False, 'items': items}
+
+    def count_documents(self):
+        return len(self.documents)
+
+
+def make_notification(key, etag):
+    return {
+        'eventName': 'ObjectCreated:Put',
+        's3': {'bucket': {'name': BUCKET}, 'object': {'key': key, 'eTag': etag}},
+    }
+
+
+def make_sqs_batch(batch_size, sns_wrapped):
+    records = []
+    for _ in range(batch_size):
+        body = {'Records': [make_notification('benchmark/{}.json'.format(uuid.uuid4()), uuid.uuid4().hex)]}
+        if sns_wrapped:
+            body = {'Type': 'Notification', 'Message': json.dumps(body)}
+        records.append({'messageId': str(uuid.uuid4()), 'body': json.dumps(body), 'eventSource': 'aws:sqs'})
+    return {'Records': records}
+
+
+def fake_head_bucket_object(bucket, key):
+    return {
+        'ContentLength': 4096,
+        'LastModified': datetime.datetime(2017, 6, 1, tzinfo=datetime.timezone.utc),
+        'ContentType': 'application/json',
+        'ETag': '"{}"'.format(key),
+    }
+
+
+def count_local_documents(es_client):
+    es_client.indices.refresh(index=lambdas.es_write_alias)
+    return es_client.count(index=lambdas.es_write_alias)['count']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the throughput of the SQS-batched metadata ingestion')
+    parser.add_argument('--batches', type=int, default=20, help='Number of SQS batches')
+    parser.add_argument('--batch-size', type=int, default=10, help='Messages per SQS batch')
+    parser.add_argument('--sns-wrapped', action='store_true', help='Wrap the S3 events in SNS envelopes')
+    parser.add_argument('--elasticsearch-endpoint', help='Local Elasticsearch URL, a fake bulk client when omitted')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.elasticsearch_endpoint:
+        es_client = Elasticsearch(hosts=[args.elasticsearch_endpoint])
+        count_documents = lambda: count_local_documents(es_client)  # noqa: E731
+    else:
+        es_client = FakeBulkClient()
+        count_documents = es_client.count_documents
+    lambdas.make_elasticsearch_client = lambda endpoint: es_client
+    lambdas.head_bucket_object = fake_head_bucket_object
+    os.environ.setdefault('ELASTICSEARCH_ENDPOINT', args.elasticsearch_endpoint or 'fake')
+
+    batches = [make_sqs_batch(args.batch_size, args.sns_wrapped) for _ in range(args.batches)]
+    started = time.time()
+    for batch in batches:
+        lambdas.handle_queued_bucket_events(batch, None)
+    elapsed = time.time() - started
+    indexed = count_documents()
+
+    # SQS redelivers a batch whose invocation failed, the deterministic ids keep the document count unchanged
+    for batch in batches:
+        lambdas.handle_queued_bucket_events(batch, None)
+    redelivered = count_documents()
+
+    total = args.batches * args.batch_size
+    print('{} documents in {:.3f}s: {:.0f} docs/sec'.format(total, elapsed, total / elapsed))
+    print('Documents after first delivery: {}, after redelivery: {}'.format(indexed, redelivered))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import functools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import urllib3
+
+SUCCESS = 'SUCCESS'
+FAILED = 'FAILED'
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 0.5
+REQUEST_TIMEOUT_SECONDS = 10
+# Time kept back from the Lambda deadline for sending the response itself
+DEADLINE_RESERVE_SECONDS = 5
+
+# Module level, so warm invocations reuse the pooled connection to the response endpoint
+http = urllib3.PoolManager(retries=False)
+responded_requests = set()
+# Requests another invocation answers, e.g. the notebook poller state machine
+deferred_requests = set()
+responded_lock = threading.Lock()
+
+
+def _mark_responded(request_id):
+    with responded_lock:
+        if request_id in responded_requests:
+            return False
+        responded_requests.add(request_id)
+        return True
+
+
+def defer(event):
+    """Marks a request as answered by a later invocation, so respond_before_deadline does not answer it."""
+    with responded_lock:
+        deferred_requests.add(event['RequestId'])
+
+
+def _is_answered(request_id):
+    with responded_lock:
+        return request_id in responded_requests or request_id in deferred_requests
+
+
+def send(event, context, response_status, data, reason=None):
+    """
+    Sends the custom resource response to CloudFormation.
+
+    Connection errors and 5xx responses are retried with exponential backoff for as long as the invocation's
+    remaining time allows. Only the first response per request is sent, a later one is logged and dropped.
+
+    :return: True when CloudFormation accepted the response
+    """
+    if not _mark_responded(event['RequestId']):
+        print('Response for request {} already sent, dropping {}'.format(event['RequestId'], response_status))
+        return False
+
+    response_url = event['ResponseURL']
+    print('CFN response url: {}'.format(response_url))
+    response_body = {
+        'Status': response_status,
+        'Reason': reason or 'See the details in CloudWatch Log Stream: ' + context.log_stream_name,
+        # Update and Delete must keep the physical id, a new one makes CloudFormation delete the old resource
+        'PhysicalResourceId': event.get('PhysicalResourceId', context.log_stream_name),
+        'StackId': event['StackId'],
+        'RequestId': event['RequestId'],
+        'LogicalResourceId': event['LogicalResourceId'],
+        'Data': data,
+    }
+    json_response = json.dumps(response_body)
+    print("Response body:\n" + json_response)
+    headers = {
+        'content-type': '',
+        'content-length': str(len(json_response))
+    }
+
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - 0.5
+    for attempt in range(MAX_ATTEMPTS):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            response = http.request(
+                'PUT',
+                response_url,
+                body=json_response,
+                headers=headers,
+                timeout=urllib3.Timeout(total=min(remaining, REQUEST_TIMEOUT_SECONDS))
+            )
+            print("Status code: {} {}".format(response.status, response.reason))
+            # 4xx means the presigned URL itself is rejected, retrying cannot help
+            if response.status < 500:
+                return response.status < 300
+        except urllib3.exceptions.HTTPError as e:
+            print("send(..) attempt {} failed: {}".format(attempt + 1, e))
+        time.sleep(max(0, min(BACKOFF_SECONDS * 2 ** attempt, deadline - time.monotonic())))
+    print('Could not deliver the {} response to CloudFormation'.format(response_status))
+    return False
+
+
+def respond_before_deadline(handler):
+    """
+    Decorates a custom resource handler so CloudFormation always gets an answer.
+
+    The handler runs in a worker thread; if it has not returned DEADLINE_RESERVE_SECONDS before the Lambda
+    deadline, or raises, a FAILED response is sent instead of leaving the stack waiting for the custom resource
+    timeout. A handler that returns without answering, and without deferring the request, gets a FAILED response
+    sent for it as well.
+    Invocations that are not CloudFormation requests are passed through unchanged.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if 'ResponseURL' not in event:
+            return handler(event, context)
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(handler, event, context)
+        budget = context.get_remaining_time_in_millis() / 1000 - DEADLINE_RESERVE_SECONDS
+        try:
+            result = future.result(timeout=max(0, budget))
+            if not _is_answered(event['RequestId']):
+                print('Handler returned without answering the {} request'.format(event['RequestType']))
+                send(event, context, FAILED, {},
+                     reason='{} request not handled, see CloudWatch Log Stream: {}'.format(
+                         event['RequestType'], context.log_stream_name))
+            return result
+        except TimeoutError:
+            print('Handler did not finish before the Lambda deadline')
+            send(event, context, FAILED, {}, reason='Timed out, see CloudWatch Log Stream: ' + context.log_stream_name)
+        except Exception:
+            send(event, context, FAILED, {})
+            raise
+        finally:
+            executor.shutdown(wait=False)
+    return wrapper
@@ -1,32 +1,66 @@
 from __future__ import print_function
 
 import base64
+import hashlib
+import itertools
 import json
 import os
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from aws_requests_auth.aws_auth import AWSRequestsAuth
 from botocore.exceptions import ClientError
-from botocore.vendored import requests
-from elasticsearch import Elasticsearch, RequestsHttpConnection, ElasticsearchException
+from elasticsearch import Elasticsearch, RequestsHttpConnection, ElasticsearchException, helpers
 
-CFN_SUCCESS = 'SUCCESS'
-CFN_FAILED = 'FAILED'
-TMP_KIBANA_JSON_PATH = '/tmp/kibana_dashboards.json'
+import cfn_response
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+CFN_SUCCESS = cfn_response.SUCCESS
+CFN_FAILED = cfn_response.FAILED
+SAVED_OBJECTS_CHUNK_SIZE = 100
 
 s3 = boto3.client('s3')
-s3_resource = boto3.resource('s3')
 es_index = 'metadata'
+# Documents are written through an alias over rollover indices metadata-000001, metadata-000002, ...
+es_write_alias = 'metadata-write'
+es_first_index = 'metadata-000001'
+METADATA_INDEX_TEMPLATE = {
+    'template': 'metadata-0*',
+    'settings': {'number_of_shards': 1},
+    'mappings': {
+        '_default_': {
+            'dynamic': False,
+            'properties': {
+                'key': {'type': 'keyword'},
+                'ContentLength': {'type': 'long'},
+                'SizeMiB': {'type': 'double'},
+                'LastModified': {'type': 'date'},
+                'ContentType': {'type': 'keyword'},
+                'ETag': {'type': 'keyword'},
+                'Dataset': {'type': 'keyword'},
+            }
+        }
+    }
+}
+METADATA_ROLLOVER_CONDITIONS = {'max_age': '30d', 'max_docs': 1000000}
+metadata_index_ready = False
 
 
 def make_elasticsearch_client(elasticsearch_endpoint):
+    # Resolved through boto3 so the client also works outside Lambda, e.g. for the backfill command
+    session = boto3.Session()
+    credentials = session.get_credentials().get_frozen_credentials()
     awsauth = AWSRequestsAuth(
-        aws_access_key=os.environ['AWS_ACCESS_KEY_ID'],
-        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
-        aws_token=os.environ['AWS_SESSION_TOKEN'],
+        aws_access_key=credentials.access_key,
+        aws_secret_access_key=credentials.secret_key,
+        aws_token=credentials.token,
         aws_host=elasticsearch_endpoint,
-        aws_region=os.environ['AWS_REGION'],
+        aws_region=session.region_name,
         aws_service='es'
     )
     return Elasticsearch(
@@ -42,94 +76,259 @@ def handle_bucket_event(event, context):
     bucket = sns_message["Records"][0]["s3"]["bucket"]["name"]
     key = urllib.parse.unquote_plus(sns_message["Records"][0]["s3"]["object"]["key"])
     print(bucket, key)
+    response = head_bucket_object(bucket, key)
+    metadata = make_metadata_document(key, response)
+    print("METADATA: " + str(metadata))
+
+    es_client = make_elasticsearch_client(os.environ['ELASTICSEARCH_ENDPOINT'])
+
+    try:
+        ensure_metadata_index(es_client)
+        es_client.index(
+            index=es_write_alias,
+            doc_type=bucket,
+            id=make_metadata_document_id(bucket, metadata),
+            body=json.dumps(metadata)
+        )
+    except ElasticsearchException as e:
+        print(e)
+        print("Could not index in Elasticsearch")
+        raise e
+
+
+def head_bucket_object(bucket, key):
     try:
-        response = s3.head_object(Bucket=bucket, Key=key)
+        return s3.head_object(Bucket=bucket, Key=key)
     except ClientError as e:
         print(e)
         print('Error getting object {} from bucket {}. Make sure they exist, your bucket is in the same region as this function and necessary permissions have been granted.'.format(key, bucket))
         raise e
 
-    metadata = {
+
+def ensure_metadata_index(es_client):
+    """
+    Installs the metadata index template and creates the first rollover index behind the write alias.
+
+    Runs once per container; indexing into a missing alias would otherwise create a concrete index with
+    dynamically guessed mappings.
+    """
+    global metadata_index_ready
+    if metadata_index_ready:
+        return
+    es_client.indices.put_template(name=es_index, body=METADATA_INDEX_TEMPLATE)
+    if not es_client.indices.exists_alias(name=es_write_alias):
+        es_client.indices.create(index=es_first_index, body={'aliases': {es_write_alias: {}}}, ignore=400)
+    metadata_index_ready = True
+
+
+def rollover_metadata_index(event, context):
+    """Scheduled handler rolling the write alias over to a new index once the current one is old or large."""
+    es_client = make_elasticsearch_client(os.environ['ELASTICSEARCH_ENDPOINT'])
+    ensure_metadata_index(es_client)
+    response = es_client.indices.rollover(alias=es_write_alias, body={'conditions': METADATA_ROLLOVER_CONDITIONS})
+    print('Rollover: ' + str(response))
+
+
+def make_metadata_document_id(bucket, metadata):
+    """Deterministic id so re-deliveries of the same object version overwrite instead of duplicating."""
+    return hashlib.sha1('/'.join([bucket, metadata['key'], metadata['ETag']]).encode('utf8')).hexdigest()
+
+
+def make_metadata_document(key, head_response):
+    return {
         'key': key,
-        'ContentLength': response['ContentLength'],
-        'SizeMiB': response['ContentLength'] / 1024**2,
-        'LastModified': response['LastModified'].isoformat(),
-        'ContentType': response['ContentType'],
-        'ETag': response['ETag'],
+        'ContentLength': head_response['ContentLength'],
+        'SizeMiB': head_response['ContentLength'] / 1024**2,
+        'LastModified': head_response['LastModified'].isoformat(),
+        'ContentType': head_response['ContentType'],
+        'ETag': head_response['ETag'],
         'Dataset': key.split('/')[0]
     }
-    print("METADATA: " + str(metadata))
+
+
+def parse_queued_bucket_events(event):
+    """
+    Extracts unique (bucket, key, etag) triples from an SQS batch of S3 notifications.
+
+    Messages may carry the S3 event directly or wrapped in an SNS envelope. Re-deliveries and
+    repeated notifications for the same object version are collapsed so each object is looked
+    up and indexed once per batch. Malformed messages are logged and skipped, redelivering them
+    would only block the valid objects of the batch until the messages expire.
+    """
+    objects = {}
+    for message in event['Records']:
+        try:
+            message_objects = parse_queued_message(message)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print('Skipping malformed message {}: {!r}'.format(message.get('messageId'), e))
+            continue
+        for bucket_object in message_objects:
+            objects[bucket_object] = None
+    return list(objects)
+
+
+def parse_queued_message(message):
+    """Returns the (bucket, key, etag) triples of the ObjectCreated records of one SQS message."""
+    body = json.loads(message['body'])
+    if 'Message' in body:
+        body = json.loads(body['Message'])
+    objects = []
+    # s3:TestEvent notifications carry no Records
+    for record in body.get('Records', []):
+        if not record['eventName'].startswith('ObjectCreated'):
+            continue
+        bucket = record['s3']['bucket']['name']
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'])
+        etag = record['s3']['object'].get('eTag')
+        objects.append((bucket, key, etag))
+    return objects
+
+
+def index_metadata_documents(es_client, documents):
+    """
+    Writes (bucket, metadata) pairs to the metadata index with a single bulk request.
+
+    :param es_client: Elasticsearch client, any object accepted by elasticsearch.helpers.bulk
+    :param documents: iterable of (bucket, metadata) tuples
+    :return: number of successfully indexed documents
+    """
+    actions = (
+        {
+            '_index': es_write_alias,
+            '_type': bucket,
+            '_id': make_metadata_document_id(bucket, metadata),
+            '_source': metadata
+        }
+        for bucket, metadata in documents
+    )
+    indexed, _ = helpers.bulk(es_client, actions)
+    return indexed
+
+
+def handle_queued_bucket_events(event, context):
+    """
+    SQS-triggered alternative to handle_bucket_event.
+
+    Consumes a batch of S3 notifications (up to the event source mapping batch size), deduplicates
+    them by bucket/key/ETag and writes all metadata documents with one bulk request instead of
+    one synchronous index call per object. Any failure raises, so SQS redelivers the batch.
+    """
+    objects = parse_queued_bucket_events(event)
+    print('Received {} records, {} unique objects'.format(len(event['Records']), len(objects)))
+    if not objects:
+        return
+
+    documents = []
+    for bucket, key, _ in objects:
+        try:
+            response = head_bucket_object(bucket, key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                print('Skipping {}/{}: object no longer exists'.format(bucket, key))
+                continue
+            raise e
+        documents.append((bucket, make_metadata_document(key, response)))
 
     es_client = make_elasticsearch_client(os.environ['ELASTICSEARCH_ENDPOINT'])
 
     try:
-        es_client.index(index=es_index, doc_type=bucket, body=json.dumps(metadata))
+        ensure_metadata_index(es_client)
+        indexed = index_metadata_documents(es_client, documents)
+        print('Indexed {} documents'.format(indexed))
     except ElasticsearchException as e:
         print(e)
-        print("Could not index in Elasticsearch")
+        print("Could not bulk index in Elasticsearch")
         raise e
 
 
-def create_metadata_visualizations(elasticsearch_endpoint):
+def content_hash(source):
+    return hashlib.sha256(json.dumps(source, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def fetch_saved_object_hashes(es_client, saved_objects):
+    docs = [{'_type': doc_type, '_id': doc_id} for doc_type, doc_id, _ in saved_objects]
+    response = es_client.mget(index='.kibana', body={'docs': docs}, ignore=404)
+    return {
+        (doc['_type'], doc['_id']): content_hash(doc['_source'])
+        for doc in response.get('docs', []) if doc.get('found')
+    }
+
+
+def bulk_import_saved_objects(es_client, saved_objects):
+    """
+    Writes (type, id, source) Kibana saved objects with bulk requests, skipping objects whose
+    stored content hash is unchanged so re-imports only touch what changed.
+
+    saved_objects may be any iterable; it is consumed in chunks of SAVED_OBJECTS_CHUNK_SIZE so a
+    streamed dashboard bundle is never materialized in memory as a whole.
+    """
+    saved_objects = iter(saved_objects)
+    imported, total = 0, 0
+    while True:
+        chunk = list(itertools.islice(saved_objects, SAVED_OBJECTS_CHUNK_SIZE))
+        if not chunk:
+            break
+        existing_hashes = fetch_saved_object_hashes(es_client, chunk)
+        actions = [
+            {'_index': '.kibana', '_type': doc_type, '_id': doc_id, '_source': source}
+            for doc_type, doc_id, source in chunk
+            if existing_hashes.get((doc_type, doc_id)) != content_hash(source)
+        ]
+        if actions:
+            helpers.bulk(es_client, actions)
+        imported += len(actions)
+        total += len(chunk)
+    print('Imported {} of {} saved objects'.format(imported, total))
+
+
+def stream_json_array(body):
+    """
+    Yields the items of a top-level JSON array from a file-like object.
+
+    Parses incrementally with ijson when it is available, otherwise falls back to json.load.
+    """
+    if ijson is None:
+        yield from json.load(body)
+    else:
+        yield from ijson.items(body, 'item', use_float=True)
+
+
+def create_metadata_visualizations(elasticsearch_endpoint, visualizations):
     es_client = make_elasticsearch_client(elasticsearch_endpoint)
-    es_client.index(index='.kibana', doc_type='config', id='5.1.1', body=json.dumps({'defaultIndex': 'metadata'}))
-    data = {'title': 'metadata', 'timeFieldName': 'LastModified'}
-    es_client.index(index='.kibana', doc_type='index-pattern', id='metadata', body=json.dumps(data))
-    with open(TMP_KIBANA_JSON_PATH) as visualizations_file:
-        visualizations = json.load(visualizations_file)
-    for visualization in visualizations:
-        es_client.index(
-            index='.kibana',
-            doc_type=visualization['_type'],
-            id=visualization['_id'],
-            body=json.dumps(visualization['_source'])
+    ensure_metadata_index(es_client)
+    saved_objects = itertools.chain(
+        [
+            ('config', '5.1.1', {'defaultIndex': 'metadata'}),
+            ('index-pattern', 'metadata', {'title': 'metadata-*', 'timeFieldName': 'LastModified'}),
+        ],
+        (
+            (visualization['_type'], visualization['_id'], visualization['_source'])
+            for visualization in visualizations
         )
+    )
+    bulk_import_saved_objects(es_client, saved_objects)
 
 
+@cfn_response.respond_before_deadline
 def register_metadata_dashboard(event, context):
     if event['RequestType'] != 'Create':
         return send_cfnresponse(event, context, CFN_SUCCESS, {})
-    quickstart_bucket = s3_resource.Bucket(event['ResourceProperties']['QSS3BucketName'])
     kibana_dashboards_key = os.path.join(
         event['ResourceProperties']['QSS3KeyPrefix'],
         'assets/kibana/kibana_metadata_visualizations.json'
     )
     elasticsearch_endpoint = event['ResourceProperties']['ElasticsearchEndpoint']
     try:
-        quickstart_bucket.download_file(kibana_dashboards_key, TMP_KIBANA_JSON_PATH)
-        create_metadata_visualizations(elasticsearch_endpoint)
+        response = s3.get_object(Bucket=event['ResourceProperties']['QSS3BucketName'], Key=kibana_dashboards_key)
+        create_metadata_visualizations(elasticsearch_endpoint, stream_json_array(response['Body']))
         return send_cfnresponse(event, context, CFN_SUCCESS, {})
     except (ClientError, ElasticsearchException) as e:
         print(e)
         return send_cfnresponse(event, context, CFN_FAILED, {})
 
 
-def send_cfnresponse(event, context, response_status, data: dict):
-    response_url = event['ResponseURL']
-    print('CFN response url: {}'.format(response_url))
-
-    response_body = {}
-    response_body['Status'] = response_status
-    response_body['Reason'] = 'See the details in CloudWatch Log Stream: ' + context.log_stream_name
-    response_body['PhysicalResourceId'] = context.log_stream_name
-    response_body['StackId'] = event['StackId']
-    response_body['RequestId'] = event['RequestId']
-    response_body['LogicalResourceId'] = event['LogicalResourceId']
-    response_body['Data'] = data
-
-    json_response = json.dumps(response_body)
-    print("Response body:\n" + json_response)
-
-    headers = {
-        'content-type': '',
-        'content-length': str(len(json_response))
-    }
-
-    try:
-        response = requests.put(response_url, data=json_response, headers=headers)
-        print("Status code: " + response.reason)
-    except Exception as e:
-        print("send(..) failed executing requests.put(..): " + str(e))
+def send_cfnresponse(event, context, response_status, data: dict, reason=None):
+    return cfn_response.send(event, context, response_status, data, reason=reason)
 
 """
 ------------------------------------------------------------------------------------------------------------------------
@@ -138,6 +337,9 @@ SageMaker lambdas
 """
 
 sm_client = boto3.client('sagemaker')
+sfn_client = boto3.client('stepfunctions')
+# The poller state machine waits 30 seconds between polls, this keeps it under the 1 hour custom resource timeout
+NOTEBOOK_MAX_POLLS = 110
 
 
 def prepare_proper_content_format(text):
@@ -175,89 +377,167 @@ def create_lifecycle_config(instance_name, event, region):
         raise Exception
 
 
-def delete_notebook_instance(instance_name):
-    def _exists_with_status(instance_name, status):
-        notebooks_with_status = sm_client.list_notebook_instances(
-            NameContains=instance_name,
-            StatusEquals=status
-        )
-        return instance_name in [
-            ntbk['NotebookInstanceName'] for ntbk in notebooks_with_status['NotebookInstances']
-        ]
+def describe_sagemaker_resource(describe, **kwargs):
+    try:
+        return describe(**kwargs)
+    except ClientError as e:
+        # SageMaker reports unknown resources as a ValidationException
+        if e.response['Error']['Code'] == 'ValidationException':
+            return None
+        raise e
 
-    if _exists_with_status(instance_name, 'Pending'):
-        waiter = sm_client.get_waiter('notebook_instance_in_service')
-        waiter.wait(NotebookInstanceName=instance_name)
 
-    if _exists_with_status(instance_name, 'InService'):
-        sm_client.stop_notebook_instance(
-            NotebookInstanceName=instance_name
-        )
-        waiter = sm_client.get_waiter('notebook_instance_stopped')
-        waiter.wait(NotebookInstanceName=instance_name)
+def get_notebook_instance_status(instance_name):
+    response = describe_sagemaker_resource(sm_client.describe_notebook_instance, NotebookInstanceName=instance_name)
+    return response['NotebookInstanceStatus'] if response else None
 
-    if _exists_with_status(instance_name, 'Stopped'):
+
+def advance_notebook_creation(instance_name):
+    status = get_notebook_instance_status(instance_name)
+    if status in (None, 'Failed'):
+        raise Exception(f'Notebook instance {instance_name} could not be started, status: {status}')
+    return status == 'InService'
+
+
+def advance_notebook_deletion(instance_name):
+    status = get_notebook_instance_status(instance_name)
+    print(f'Notebook instance {instance_name} status: {status}')
+    if status is None:
+        return True
+    if status == 'InService':
+        sm_client.stop_notebook_instance(NotebookInstanceName=instance_name)
+    elif status in ('Stopped', 'Failed'):
         sm_client.delete_notebook_instance(NotebookInstanceName=instance_name)
-    else:
-        print(f'Warning! Cannot delete {instance_name}: not found in none of the states: pending, in service or stopped.')
+    # Pending, Updating, Stopping and Deleting need another poll
+    return False
 
 
 def delete_model(model_name):
-    def model_exists():
-        models = sm_client.list_models(NameContains=model_name)
-        return model_name in [mdl['ModelName'] for mdl in models['Models']]
-
-    if model_exists():
+    if describe_sagemaker_resource(sm_client.describe_model, ModelName=model_name):
         sm_client.delete_model(ModelName=model_name)
     else:
         print(f'Warning! {model_name} model does not exist')
 
 
 def delete_endpoint(endpoint_name):
-    def endpoint_exists():
-        endpoints = sm_client.list_endpoints(NameContains=endpoint_name)
-        return endpoint_name in [endpt['EndpointName'] for endpt in endpoints['Endpoints']]
-
-    if endpoint_exists():
+    if describe_sagemaker_resource(sm_client.describe_endpoint, EndpointName=endpoint_name):
         sm_client.delete_endpoint(EndpointName=endpoint_name)
     else:
         print(f'Warning! {endpoint_name} endpoint does not exist')
 
+
 def delete_lifecycle_config(config_name):
-    def lifecycle_config():
-        def name(obj):
-            return obj['NotebookInstanceLifecycleConfigName']
-        lifecycle_configs = sm_client.list_notebook_instance_lifecycle_configs(NameContains=config_name)
-        configs = lifecycle_configs['NotebookInstanceLifecycleConfigs']
-        return config_name in [name(cnf) for cnf in configs]
-
-    if lifecycle_config():
+    if describe_sagemaker_resource(
+            sm_client.describe_notebook_instance_lifecycle_config,
+            NotebookInstanceLifecycleConfigName=config_name):
         sm_client.delete_notebook_instance_lifecycle_config(
             NotebookInstanceLifecycleConfigName=config_name
         )
     else:
         print(f'Warning! {config_name} lifecycle config does not exist')
 
+
+def start_sagemaker_teardown(event):
+    """
+    Issues all independent SageMaker deletions concurrently.
+
+    The model, endpoint and lifecycle config are deleted while the notebook instance is moved one
+    step towards deletion, so a stack delete takes as long as the slowest resource. Returns True
+    when the notebook instance is already gone and no polling is needed.
+    """
+    instance_name = event['ResourceProperties']['NotebookInstanceName']
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        notebook_deleted = executor.submit(advance_notebook_deletion, instance_name)
+        deletions = [
+            executor.submit(delete_model, make_model_name(event)),
+            executor.submit(delete_endpoint, make_endpoint_name(event)),
+            executor.submit(delete_lifecycle_config, make_lifecycle_config_name(instance_name)),
+        ]
+        for deletion in deletions:
+            deletion.result()
+        return notebook_deleted.result()
+
+
+def make_notebook_response_data(instance_name):
+    region = os.environ['AWS_REGION']
+    return {
+        'SageMakerNotebookURL': f'https://{instance_name}.notebook.{region}.sagemaker.aws/tree?',
+    }
+
+
+def start_notebook_poller(event):
+    sfn_client.start_execution(
+        stateMachineArn=event['ResourceProperties']['NotebookPollerStateMachineArn'],
+        input=json.dumps({'Event': event, 'Attempt': 0, 'Complete': False})
+    )
+    cfn_response.defer(event)
+
+
+def poll_notebook_operation(state, context):
+    """
+    One step of the notebook poller state machine.
+
+    Advances the pending Create or Delete request by a single describe_notebook_instance call and
+    answers CloudFormation once the operation has finished, failed or run out of polls. The
+    returned state has Complete set to True when the state machine should stop. A state with an
+    Error is the state machine's catch of a poll that kept failing, it is answered with FAILED.
+    """
+    event = state['Event']
+    instance_name = event['ResourceProperties']['NotebookInstanceName']
+    attempt = state['Attempt'] + 1
+    completed_state = dict(state, Attempt=attempt, Complete=True)
+    if 'Error' in state:
+        print('Poll failed: ' + json.dumps(state['Error']))
+        send_cfnresponse(event, context, CFN_FAILED, {},
+                         reason=f'Polling notebook instance {instance_name} failed: {state["Error"].get("Error")}')
+        return completed_state
+    try:
+        if event['RequestType'] == 'Create':
+            if advance_notebook_creation(instance_name):
+                send_cfnresponse(event, context, CFN_SUCCESS, make_notebook_response_data(instance_name))
+                return completed_state
+        elif advance_notebook_deletion(instance_name):
+            send_cfnresponse(event, context, CFN_SUCCESS, {})
+            return completed_state
+        if attempt >= NOTEBOOK_MAX_POLLS:
+            raise Exception(f'Notebook instance {instance_name} did not finish {event["RequestType"]} in time')
+    except Exception as ex:
+        print('Error!')
+        print(ex)
+        send_cfnresponse(event, context, CFN_FAILED, {})
+        return completed_state
+    return dict(state, Attempt=attempt, Complete=False)
+
+
+@cfn_response.respond_before_deadline
 def lambda_handler(event, context):
+    """
+    Custom resource handler for the SageMaker notebook instance.
+
+    Create and Delete only start the operation and hand over to the poller state machine, which
+    re-invokes this handler with the poller state until the notebook instance is in service or
+    gone, so no invocation blocks on SageMaker waiters. Update leaves the notebook instance as it is
+    and answers right away.
+    """
+    if 'Event' in event:
+        return poll_notebook_operation(event, context)
     if event['RequestType'] == 'Delete':
         try:
             print('Started deleting SageMaker...')
             print(str(event))
-            instance_name = event['ResourceProperties']['NotebookInstanceName']
-
-            delete_notebook_instance(instance_name)
-            delete_model(make_model_name(event))
-            delete_endpoint(make_endpoint_name(event))
-            delete_lifecycle_config(make_lifecycle_config_name(instance_name))
-
-            send_cfnresponse(event, context, CFN_SUCCESS, {})
+            if start_sagemaker_teardown(event):
+                send_cfnresponse(event, context, CFN_SUCCESS, {})
+            else:
+                start_notebook_poller(event)
         except Exception as inst:
             print(inst)
             send_cfnresponse(event, context, CFN_FAILED, {})
+    elif event['RequestType'] == 'Update':
+        instance_name = event['ResourceProperties']['NotebookInstanceName']
+        send_cfnresponse(event, context, CFN_SUCCESS, make_notebook_response_data(instance_name))
     elif event['RequestType'] == 'Create':
         try:
             region = os.environ['AWS_REGION']
-            instance_name = event['ResourceProperties']['NotebookInstanceName']
             input_dict = {
                 'NotebookInstanceName': event['ResourceProperties']['NotebookInstanceName'],
                 'InstanceType': event['ResourceProperties']['NotebookInstanceType'],
@@ -268,15 +548,9 @@ def lambda_handler(event, context):
                                     region)
             input_dict['LifecycleConfigName'] = config_with_data['config_name']
             instance = sm_client.create_notebook_instance(**input_dict)
-
-            waiter = sm_client.get_waiter('notebook_instance_in_service')
-            waiter.wait(NotebookInstanceName=event['ResourceProperties']['NotebookInstanceName'])
             print('Sagemager CLI response for creating instance')
             print(str(instance))
-            response_data = {
-                'SageMakerNotebookURL': f'https://{instance_name}.notebook.{region}.sagemaker.aws/tree?',
-            }
-            send_cfnresponse(event, context, CFN_SUCCESS, response_data)
+            start_notebook_poller(event)
         except Exception as ex:
             print('Error!')
             print(ex)
@@ -1,3 +1,3 @@
 pushd assets/lambdas
-zip -r lambdas.zip lambdas.py
+zip -r lambdas.zip lambdas.py cfn_response.py
 popd
\ No newline at end of file
@@ -23,11 +23,46 @@ import os
 import datetime
 import hashlib
 import yaml
+import contextlib
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+import queue
+import threading
 
 code_pipeline = boto3.client('codepipeline')
 sts_client = boto3.client('sts')
 accountid = sts_client.get_caller_identity()["Account"]
 client = boto3.client('servicecatalog')
+# Publish templates as minified JSON instead of the raw source file
+MINIFY_TEMPLATES = os.environ.get('MINIFY_TEMPLATES', 'false').lower() == 'true'
+# CloudFormation limit for templates loaded from S3
+TEMPLATE_URL_MAX_BYTES = 1024 * 1024
+# Record memory, time and /tmp usage of each sync stage and print them as one PROFILE line per invocation
+PROFILE_SYNC = os.environ.get('PROFILE_SYNC', 'false').lower() == 'true'
+PROFILE_TOP_ALLOCATIONS = 10
+TMP_DIR = os.path.join(os.path.sep, 'tmp')
+# Per-stage measurements of the running invocation, None when not profiling
+_profile = None
+# Time kept back from the Lambda timeout for saving the checkpoint and answering CodePipeline
+SYNC_DEADLINE_RESERVE_MS = int(os.environ.get('SYNC_DEADLINE_RESERVE_MS', '60000'))
+CHECKPOINT_PREFIX = 'sc-sync-checkpoints/'
+# single syncs all portfolios in this invocation, coordinator fans them out to one worker per portfolio
+SYNC_MODE = os.environ.get('SYNC_MODE', 'single')
+# lambda invokes this function asynchronously per work item, local runs the workers in threads of this process
+SYNC_WORK_QUEUE = os.environ.get('SYNC_WORK_QUEUE', 'lambda')
+FANOUT_PREFIX = 'sc-sync-fanout/'
+FANOUT_POLL_SECONDS = 5
+# Portfolios without a result after this long are reported as failed
+FANOUT_TIMEOUT_SECONDS = int(os.environ.get('FANOUT_TIMEOUT_SECONDS', '1800'))
+FANOUT_LOCAL_WORKERS = 4
+FANOUT_REPORTED_FAILURES = 10
+
+
+class SyncDeadlineReached(Exception):
+    """ Raised between portfolios and products when the invocation has to stop and checkpoint """
 
 
 def handler(event, context):
@@ -36,161 +71,666 @@ def handler(event, context):
         2. Get Job Data from input
         3. Get Artifact data from input
         4. Setup S3 Client
-        5. Sync Codebase with Service Catalog
+        5. Load the checkpoint when CodePipeline resumes the job with a continuation token
+        6. Sync Codebase with Service Catalog
+        7. Close to the Lambda timeout, save the checkpoint and hand its key to CodePipeline as continuation token
+    In coordinator mode the portfolios are synced by workers instead, see coordinate_sync. Workers are invocations
+    of this handler with a SyncWorker event, see run_sync_worker.
     :param event: Input json from code pipeline, containing job id and input artifacts
-    :param context: Not used, but required for Lambda function
+    :param context: Lambda context, used to stop before the timeout
     :return: None
     :exception: Any exception
     """
     print(event)
+    tmp_files = list_tmp_files() if PROFILE_SYNC else None
+    if PROFILE_SYNC:
+        start_profile()
+    work_dir = tempfile.mkdtemp(dir=TMP_DIR)
+    work_dir_bytes = 0
     try:
+        if 'SyncWorker' in event:
+            run_sync_worker(setup_s3_client(), event['SyncWorker'], work_dir, context)
+            return
         job_id = event['CodePipeline.job']['id']
         job_data = event['CodePipeline.job']['data']
         artifact_data = job_data['inputArtifacts'][0]
+        bucket = artifact_data['location']['s3Location']['bucketName']
         s3 = setup_s3_client()
-        sync_service_catalog(s3, artifact_data)
+        continuation_token = job_data.get('continuationToken')
+        if SYNC_MODE == 'coordinator':
+            coordinate_sync(s3, job_id, artifact_data, work_dir, continuation_token,
+                            make_work_queue(s3, context), context)
+            return
+        checkpoint = load_checkpoint(s3, bucket, continuation_token)
+        sync_service_catalog(s3, artifact_data, work_dir, checkpoint, context)
+        if continuation_token:
+            s3.delete_object(Bucket=bucket, Key=continuation_token)
         put_job_success(job_id, "Success")
+    except SyncDeadlineReached:
+        continuation_token = save_checkpoint(s3, bucket, checkpoint, continuation_token)
+        put_job_success(job_id, 'Sync checkpointed after {} portfolios and {} products, resuming'
+                        .format(len(checkpoint['portfolios']), len(checkpoint['products'])),
+                        continuation_token=continuation_token)
     except Exception as e:
         print('Function failed due to exception.')
         print(e)
         traceback.print_exc()
         put_job_failure(job_id, 'Function exception: ' + str(e))
+    finally:
+        # Warm containers keep /tmp, so nothing of the invocation may be left behind
+        if PROFILE_SYNC:
+            work_dir_bytes = directory_size(work_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if PROFILE_SYNC:
+            report_profile(work_dir_bytes, tmp_files)
 
 
-def sync_service_catalog(s3, artifact):
+def sync_service_catalog(s3, artifact, work_dir, checkpoint, context=None):
     """ Pseudo logic as follows
         1. Extract S3 Zip file
         2. Iterate through all the folders starting with portfolio-
-        3. Read mapping.yaml in each such folder. Refer Readme for more details on syntax
-        4. If portfolio name matches, update the products by creating a new version
-        5. If portfolio name does not matches, create a new one.
-        6. Share the portfolio with list of accounts mentioned in the mapping.yaml
-        7. Give access to the principals mentioned in the mapping.yaml
-        8. Tag Portfolio as mentioned in mapping.yaml
+        3. Sync the portfolio of each mapping.yaml in such folder, see sync_portfolio
+    Portfolios and products recorded in the checkpoint are skipped, newly completed ones are added to it.
     
     :param s3: S3 Boto3 client
     :param artifact: Artifact object sent by codepipeline
+    :param work_dir: Empty directory the artifact is extracted into, removed by the caller
+    :param checkpoint: Completed portfolios and products, see load_checkpoint
+    :param context: Lambda context, None when run without a deadline
+    :return: None
+    :exception: SyncDeadlineReached when the remaining time runs out before the sync is complete
+    """
+    bucket = artifact['location']['s3Location']['bucketName']
+    extract_artifact(s3, artifact, work_dir)
+    for mapping_id in find_mappings(work_dir):
+        sync_portfolio(s3, bucket, work_dir, mapping_id, checkpoint, context)
+
+
+def extract_artifact(s3, artifact, work_dir, members_prefix=None):
+    """ Downloads the pipeline artifact and extracts it into the working directory
+    :param s3: S3 Boto3 client
+    :param artifact: Artifact object sent by codepipeline
+    :param work_dir: Empty directory the artifact is extracted into
+    :param members_prefix: Only extract the archive members below this path, all when None
     :return: None
     """
     bucket = artifact['location']['s3Location']['bucketName']
     key = artifact['location']['s3Location']['objectKey']
-    tmp_dir = os.path.join(os.path.sep, 'tmp')
-    tmp_file = os.path.join(tmp_dir, str(uuid.uuid4()))
-    print("DEBUG: Downloading {} to s3 location {}/{}"
-          .format(tmp_file, bucket, key))
-    s3.download_file(bucket, key, tmp_file)
-    with zipfile.ZipFile(tmp_file, 'r') as zip:
-        zip.extractall(tmp_dir)
-        print(os.listdir(tmp_dir))
-        print('Extract Complete')
-    
-    portfolios_path = os.path.join(tmp_dir, 'packages')
-    portfolios_dirs = os.listdir(portfolios_path)
-    for folder in portfolios_dirs:
+    tmp_file = os.path.join(work_dir, str(uuid.uuid4()))
+    with profile_stage('extract'):
+        print("DEBUG: Downloading {} to s3 location {}/{}"
+              .format(tmp_file, bucket, key))
+        s3.download_file(bucket, key, tmp_file)
+        with zipfile.ZipFile(tmp_file, 'r') as zip:
+            members = None
+            if members_prefix is not None:
+                members = [name for name in zip.namelist() if name.startswith(members_prefix)]
+            zip.extractall(work_dir, members)
+            print(os.listdir(work_dir))
+            print('Extract Complete')
+        os.remove(tmp_file)
+
+
+def find_mappings(work_dir):
+    """ Lists the portfolio mappings of an extracted artifact
+    :param work_dir: Directory the artifact was extracted into
+    :return: Mapping ids, the mapping file path relative to the packages folder
+    """
+    portfolios_path = os.path.join(work_dir, 'packages')
+    mapping_ids = []
+    for folder in os.listdir(portfolios_path):
         vendor_dir = os.path.join(portfolios_path, folder)
         if os.path.isdir(vendor_dir):
             print('Found ' + folder + ' as folder')
             for mappingfile in os.listdir(vendor_dir):
                 print('Found ' + mappingfile + ' inside folder ' + folder)
                 if str(mappingfile).endswith('mapping.yaml'):
-                    print('Working with ' + mappingfile + ' inside folder ' + folder)
-                    mapping_path = os.path.join(vendor_dir, mappingfile) 
-                    with open(mapping_path, 'r') as stream:
-                        objfile = yaml.load(stream)
-                    # objfile = json.loads("/tmp/"+folder+"/"+mappingfile)
-                    print('Loaded JSON=' + str(objfile))
-                    lst_portfolio = list_portfolios()
-                    lst_portfolio_name = []
-                    obj_portfolio = {}
-                    for portfolio in lst_portfolio:
-                        if portfolio['DisplayName'] not in lst_portfolio_name:
-                            lst_portfolio_name.append(portfolio['DisplayName'])
-                    if objfile['name'] in lst_portfolio_name:
-                        print('PORTFOLIO Match found.Checking Products now.')
-                        for item in lst_portfolio:
-                            if item['DisplayName'] == objfile['name']:
-                                PortfolioId = item['Id']
-                                obj_portfolio = item
-                        update_portfolio(obj_portfolio, objfile, bucket)
-                        remove_principal_with_portfolio(obj_portfolio['Id'])
-                        associate_principal_with_portfolio(obj_portfolio, objfile)
-                        lst_products = list_products_for_portfolio(PortfolioId)
-                        lst_products_name = []
-                        for products in lst_products:
-                            lst_products_name.append(products['Name'])
-                        for productsInFile in objfile['products']:
-                            product_path = os.path.join(vendor_dir, productsInFile['template'])
-                            mapping_name = str(mappingfile).split(".yaml")[0]
-                            md5_key = md5(filename=product_path)
-                            s3key = ('sc-templates/'
-                                     + vendor_dir
-                                     + mapping_name
-                                     + productsInFile['name']
-                                     + '/templates/'
-                                     + md5_key + '.yaml'
-                                     )
-                            if productsInFile['name'] in lst_products_name:
-                                print('Updating existing product {} in portfolio {}...'
-                                      .format(productsInFile['name'],
-                                              objfile['name']))
-                                for ids in lst_products:
-                                    if ids['Name'] == productsInFile['name']:
-                                        productid = ids['ProductId']
-                                # Check if product has changed. If it has then
-                                # update
-                                md5_changed, local_md5, remote_md5 = has_md5_changed(s3_client=s3,
-                                                                                     bucket_name=bucket,
-                                                                                     key=s3key,
-                                                                                     local_file=product_path) 
-                                if md5_changed:
-                                    s3.upload_file(product_path, bucket, s3key)
-                                    print("DEBUG: Local and remote checksums mismatch, "
-                                          "updating product... {}!={}"
-                                          .format(local_md5, remote_md5))
-                                    create_provisioning_artifact(productsInFile, productid, bucket + "/" + s3key)
-                                else:
-                                    print("DEBUG: Local and remote checksums match, not updating...")
-                            else:
-                                print('Adding new product {} to existing portfolio {}...'
-                                      .format(productsInFile['name'],
-                                              objfile['name']))
-                                s3.upload_file(product_path, bucket, s3key)
-                                create_product(productsInFile, PortfolioId, bucket + "/" + s3key)
-                    else:
-                        print('NO PORTFOLIO Match found.Creating one...')
-                        create_portfolio_response = create_portfolio(objfile, bucket)
-                        PortfolioId = create_portfolio_response['PortfolioDetail']['Id']
-                        associate_principal_with_portfolio(create_portfolio_response['PortfolioDetail'], objfile)
-                        for productsInFile in objfile['products']:
-                            product_path = os.path.join(vendor_dir, productsInFile['template'])
-                            md5_key = md5(filename=product_path)
-                            s3key = ('sc-templates/'
-                                     + vendor_dir
-                                     + mapping_name
-                                     + productsInFile['name']
-                                     + '/templates/'
-                                     + md5_key + '.yaml'
-                                     )
-                            s3.upload_file(product_path, bucket, s3key)
-                            create_product(productsInFile, PortfolioId, bucket + "/" + s3key)
-
-def has_md5_changed(s3_client, bucket_name, key, local_file):
+                    mapping_ids.append(os.path.join(folder, mappingfile))
+    return mapping_ids
+
+
+def sync_portfolio(s3, bucket, work_dir, mapping_id, checkpoint, context=None, grant_bucket_access=True):
+    """ Pseudo logic as follows
+        1. Read the mapping.yaml. Refer Readme for more details on syntax
+        2. If portfolio name matches, update the products by creating a new version
+        3. If portfolio name does not matches, create a new one.
+        4. Share the portfolio with list of accounts mentioned in the mapping.yaml
+        5. Give access to the principals mentioned in the mapping.yaml
+        6. Tag Portfolio as mentioned in mapping.yaml
+
+    :param s3: S3 Boto3 client
+    :param bucket: Artifact bucket, templates are uploaded to it
+    :param work_dir: Directory the artifact was extracted into
+    :param mapping_id: Mapping file path relative to the packages folder, see find_mappings
+    :param checkpoint: Completed portfolios and products, see load_checkpoint
+    :param context: Lambda context, None when run without a deadline
+    :param grant_bucket_access: False when the caller already updated the bucket policy, see grant_template_access
+    :return: None
+    :exception: SyncDeadlineReached when the remaining time runs out before the portfolio is synced
+    """
+    folder, mappingfile = os.path.split(mapping_id)
+    vendor_dir = os.path.join(work_dir, 'packages', folder)
+    # Template keys keep the original /tmp/packages layout, so already uploaded templates are still found
+    vendor_key_dir = os.path.join(TMP_DIR, 'packages', folder)
+    print('Working with ' + mappingfile + ' inside folder ' + folder)
+    mapping_name = str(mappingfile).split(".yaml")[0]
+    if mapping_id in checkpoint['portfolios']:
+        print('Skipping ' + mapping_id + ', synced by a previous invocation')
+        return
+    check_deadline(context)
+    with profile_stage('parse'):
+        objfile = load_mapping(work_dir, mapping_id)
+    # objfile = json.loads("/tmp/"+folder+"/"+mappingfile)
+    print('Loaded JSON=' + str(objfile))
+    lst_portfolio = list_portfolios()
+    lst_portfolio_name = []
+    obj_portfolio = {}
+    for portfolio in lst_portfolio:
+        if portfolio['DisplayName'] not in lst_portfolio_name:
+            lst_portfolio_name.append(portfolio['DisplayName'])
+    if objfile['name'] in lst_portfolio_name:
+        print('PORTFOLIO Match found.Checking Products now.')
+        for item in lst_portfolio:
+            if item['DisplayName'] == objfile['name']:
+                PortfolioId = item['Id']
+                obj_portfolio = item
+        update_portfolio(obj_portfolio, objfile, bucket, grant_bucket_access)
+        remove_principal_with_portfolio(obj_portfolio['Id'])
+        associate_principal_with_portfolio(obj_portfolio, objfile)
+        lst_products = list_products_for_portfolio(PortfolioId)
+        lst_products_name = []
+        for products in lst_products:
+            lst_products_name.append(products['Name'])
+        for productsInFile in objfile['products']:
+            product_id = mapping_id + '/' + productsInFile['name']
+            if product_id in checkpoint['products']:
+                continue
+            check_deadline(context)
+            product_path = os.path.join(vendor_dir, productsInFile['template'])
+            with profile_stage('parse'):
+                digest = template_digest(product_path)
+            s3key = make_template_s3key(vendor_key_dir, mapping_name, productsInFile['name'], digest,
+                                        template_upload_extension(product_path))
+            if productsInFile['name'] in lst_products_name:
+                print('Updating existing product {} in portfolio {}...'
+                      .format(productsInFile['name'],
+                              objfile['name']))
+                for ids in lst_products:
+                    if ids['Name'] == productsInFile['name']:
+                        productid = ids['ProductId']
+                # Check if product has changed. If it has then
+                # update. Keys are content addressed by the
+                # canonical digest, so a missing key means a change
+                if has_template_changed(s3_client=s3, bucket_name=bucket, key=s3key):
+                    with profile_stage('upload'):
+                        upload_template(s3, product_path, bucket, s3key)
+                    print("DEBUG: Canonical template changed, updating product...")
+                    create_provisioning_artifact(productsInFile, productid, bucket + "/" + s3key)
+                else:
+                    print("DEBUG: Canonical template unchanged, not updating...")
+            else:
+                print('Adding new product {} to existing portfolio {}...'
+                      .format(productsInFile['name'],
+                              objfile['name']))
+                with profile_stage('upload'):
+                    upload_template(s3, product_path, bucket, s3key)
+                create_product(productsInFile, PortfolioId, bucket + "/" + s3key)
+            checkpoint['products'].append(product_id)
+    else:
+        print('NO PORTFOLIO Match found.Creating one...')
+        create_portfolio_response = create_portfolio(objfile, bucket, grant_bucket_access)
+        PortfolioId = create_portfolio_response['PortfolioDetail']['Id']
+        associate_principal_with_portfolio(create_portfolio_response['PortfolioDetail'], objfile)
+        for productsInFile in objfile['products']:
+            product_id = mapping_id + '/' + productsInFile['name']
+            if product_id in checkpoint['products']:
+                continue
+            check_deadline(context)
+            product_path = os.path.join(vendor_dir, productsInFile['template'])
+            with profile_stage('parse'):
+                digest = template_digest(product_path)
+            s3key = make_template_s3key(vendor_key_dir, mapping_name, productsInFile['name'], digest,
+                                        template_upload_extension(product_path))
+            with profile_stage('upload'):
+                upload_template(s3, product_path, bucket, s3key)
+            create_product(productsInFile, PortfolioId, bucket + "/" + s3key)
+            checkpoint['products'].append(product_id)
+    checkpoint['portfolios'].append(mapping_id)
+
+
+class LambdaWorkQueue(object):
+    """ Hands each work item to an asynchronous invocation of this function in worker mode """
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.lambda_client = boto3.client('lambda')
+
+    def put(self, item):
+        self.lambda_client.invoke(FunctionName=self.function_name, InvocationType='Event',
+                                  Payload=json.dumps({'SyncWorker': item}).encode('utf-8'))
+
+    def join(self):
+        # The workers run on their own, the coordinator polls for their results
+        pass
+
+
+class LocalWorkQueue(object):
+    """ In-process stand-in for LambdaWorkQueue, worker threads take the items from a queue.Queue """
+
+    def __init__(self, s3_client, workers=FANOUT_LOCAL_WORKERS):
+        self.s3_client = s3_client
+        self.queue = queue.Queue()
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def join(self):
+        self.queue.join()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            work_dir = tempfile.mkdtemp(dir=TMP_DIR)
+            try:
+                run_sync_worker(self.s3_client, item, work_dir)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+                self.queue.task_done()
+
+
+def make_work_queue(s3_client, context):
+    """ Picks the work queue of the coordinator, local when configured or when not running in Lambda
+    :param s3_client: S3 Boto3 client, used by local workers
+    :param context: Lambda context
+    :return: LambdaWorkQueue or LocalWorkQueue
+    """
+    if SYNC_WORK_QUEUE == 'local' or context is None:
+        return LocalWorkQueue(s3_client)
+    return LambdaWorkQueue(context.function_name)
+
+
+def coordinate_sync(s3, job_id, artifact, work_dir, continuation_token, work_queue, context=None):
+    """ Pseudo logic as follows
+        1. Without continuation token, list the portfolio mappings of the artifact, grant their accounts access
+           to the templates in one bucket policy update, save the mappings as the run manifest and enqueue one
+           work item per portfolio
+        2. Wait for the worker results until the invocation deadline
+        3. If portfolios are still running, hand the run prefix to CodePipeline as continuation token
+        4. Otherwise report success, or failure listing the failed and timed out portfolios
+
+    :param s3: S3 Boto3 client
+    :param job_id: CodePipeline job ID
+    :param artifact: Artifact object sent by codepipeline
+    :param work_dir: Empty directory the artifact is extracted into, removed by the caller
+    :param continuation_token: Run prefix of a fan-out started by a previous invocation, None for a new job
+    :param work_queue: LambdaWorkQueue or LocalWorkQueue
+    :param context: Lambda context, None when run without a deadline
+    :return: None
+    """
+    bucket = artifact['location']['s3Location']['bucketName']
+    run_prefix = continuation_token
+    if run_prefix is None:
+        extract_artifact(s3, artifact, work_dir)
+        run_prefix = FANOUT_PREFIX + str(uuid.uuid4()) + '/'
+        manifest = {'mappings': find_mappings(work_dir), 'started': time.time()}
+        # Workers run concurrently, so the shared bucket policy is updated once here instead of by each of them
+        grant_template_access([load_mapping(work_dir, mapping_id) for mapping_id in manifest['mappings']], bucket)
+        s3.put_object(Bucket=bucket, Key=run_prefix + 'manifest.json', Body=json.dumps(manifest).encode('utf-8'),
+                      ContentType='application/json')
+        for mapping_id in manifest['mappings']:
+            work_queue.put({'artifact': artifact, 'mapping': mapping_id, 'results': run_prefix})
+        print('Enqueued {} portfolios under {}'.format(len(manifest['mappings']), run_prefix))
+        work_queue.join()
+    else:
+        response = s3.get_object(Bucket=bucket, Key=run_prefix + 'manifest.json')
+        manifest = json.loads(response['Body'].read().decode('utf-8'))
+
+    results = wait_for_results(s3, bucket, run_prefix, manifest['mappings'], context)
+    missing = [mapping_id for mapping_id in manifest['mappings'] if mapping_id not in results]
+    if missing and time.time() - manifest['started'] < FANOUT_TIMEOUT_SECONDS:
+        put_job_success(job_id, 'Waiting for {} of {} portfolios'.format(len(missing), len(manifest['mappings'])),
+                        continuation_token=run_prefix)
+        return
+
+    delete_fanout_run(s3, bucket, run_prefix)
+    failures = ['{}: {}'.format(mapping_id, result['message'])
+                for mapping_id, result in sorted(results.items()) if result['status'] != 'SUCCESS']
+    failures += ['{}: no result after {} seconds'.format(mapping_id, FANOUT_TIMEOUT_SECONDS) for mapping_id in missing]
+    if failures:
+        put_job_failure(job_id, 'Failed to sync {} of {} portfolios: {}'
+                        .format(len(failures), len(manifest['mappings']),
+                                '; '.join(failures[:FANOUT_REPORTED_FAILURES])))
+    else:
+        put_job_success(job_id, 'Synced {} portfolios'.format(len(manifest['mappings'])))
+
+
+def run_sync_worker(s3, item, work_dir, context=None):
+    """ Syncs the portfolio of one work item and records the outcome for the coordinator
+    :param s3: S3 Boto3 client
+    :param item: Work item with the artifact, the mapping id and the run prefix results are written to
+    :param work_dir: Empty directory the portfolio folder of the artifact is extracted into
+    :param context: Lambda context, None when run without a deadline
+    :return: Result recorded for the coordinator
+    """
+    bucket = item['artifact']['location']['s3Location']['bucketName']
+    result = {'mapping': item['mapping'], 'status': 'SUCCESS', 'message': 'Synced'}
+    try:
+        extract_artifact(s3, item['artifact'], work_dir,
+                         members_prefix='packages/' + os.path.dirname(item['mapping']) + '/')
+        # The coordinator granted the bucket access of all portfolios before fanning out
+        sync_portfolio(s3, bucket, work_dir, item['mapping'], load_checkpoint(s3, bucket, None), context,
+                       grant_bucket_access=False)
+    except SyncDeadlineReached:
+        result.update(status='FAILED', message='Worker ran out of time')
+    except Exception as e:
+        traceback.print_exc()
+        result.update(status='FAILED', message='Worker exception: ' + str(e))
+    print('Portfolio {}: {}'.format(item['mapping'], result['status']))
+    s3.put_object(Bucket=bucket, Key=make_result_s3key(item['results'], item['mapping']),
+                  Body=json.dumps(result).encode('utf-8'), ContentType='application/json')
+    return result
+
+
+def make_result_s3key(run_prefix, mapping_id):
+    return run_prefix + 'results/' + hashlib.sha1(mapping_id.encode('utf-8')).hexdigest() + '.json'
+
+
+def wait_for_results(s3, bucket, run_prefix, mapping_ids, context=None):
+    """ Polls the worker results until all portfolios reported or the invocation deadline is near
+    :param s3: S3 Boto3 client
+    :param bucket: Artifact bucket
+    :param run_prefix: S3 prefix of the fan-out run
+    :param mapping_ids: Mapping ids of the run manifest
+    :param context: Lambda context, results are collected once when None
+    :return: Results by mapping id
+    """
+    while True:
+        results = collect_results(s3, bucket, run_prefix)
+        if len(results) >= len(mapping_ids) or context is None:
+            return results
+        if context.get_remaining_time_in_millis() < SYNC_DEADLINE_RESERVE_MS + FANOUT_POLL_SECONDS * 1000:
+            return results
+        time.sleep(FANOUT_POLL_SECONDS)
+
+
+def collect_results(s3, bucket, run_prefix):
+    results = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=run_prefix + 'results/'):
+        for obj in page.get('Contents', []):
+            response = s3.get_object(Bucket=bucket, Key=obj['Key'])
+            result = json.loads(response['Body'].read().decode('utf-8'))
+            results[result['mapping']] = result
+    return results
+
+
+def delete_fanout_run(s3, bucket, run_prefix):
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=run_prefix):
+        keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if keys:
+            s3.delete_objects(Bucket=bucket, Delete={'Objects': keys, 'Quiet': True})
+
+
+def load_mapping(work_dir, mapping_id):
+    """ Loads a mapping.yaml of an extracted artifact
+    :param work_dir: Directory the artifact was extracted into
+    :param mapping_id: Mapping file path relative to the packages folder, see find_mappings
+    :return: mapping.yaml file object
+    """
+    with open(os.path.join(work_dir, 'packages', mapping_id), 'r') as stream:
+        return yaml.load(stream)
+
+
+def check_deadline(context):
+    """ Stops the sync when less than SYNC_DEADLINE_RESERVE_MS of the invocation are left
+    :param context: Lambda context, None when run without a deadline
+    :return: None
+    :exception: SyncDeadlineReached
+    """
+    if context is not None and context.get_remaining_time_in_millis() < SYNC_DEADLINE_RESERVE_MS:
+        raise SyncDeadlineReached()
+
+
+def load_checkpoint(s3_client, bucket, continuation_token):
+    """ Loads the progress of a resumed job, the continuation token is the S3 key of its checkpoint
+    :param s3_client: S3 Boto3 client
+    :param bucket: Artifact bucket holding the checkpoint
+    :param continuation_token: continuationToken sent by codepipeline, None for a new job
+    :return: Checkpoint with the completed portfolio mappings and products
+    """
+    if not continuation_token:
+        return {'portfolios': [], 'products': []}
+    response = s3_client.get_object(Bucket=bucket, Key=continuation_token)
+    checkpoint = json.loads(response['Body'].read().decode('utf-8'))
+    print('Resuming from {}: {} portfolios and {} products completed'
+          .format(continuation_token, len(checkpoint['portfolios']), len(checkpoint['products'])))
+    return checkpoint
+
+
+def save_checkpoint(s3_client, bucket, checkpoint, continuation_token=None):
+    """ Saves the progress of the job next to its artifact
+    :param s3_client: S3 Boto3 client
+    :param bucket: Artifact bucket
+    :param checkpoint: Completed portfolio mappings and products
+    :param continuation_token: Key of the checkpoint being resumed, reused so each job keeps a single checkpoint
+    :return: Continuation token for codepipeline
+    """
+    key = continuation_token or CHECKPOINT_PREFIX + str(uuid.uuid4()) + '.json'
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(checkpoint).encode('utf-8'),
+                         ContentType='application/json')
+    return key
+
+
+def start_profile():
+    """ Starts tracing allocations and resets the per-stage measurements of this invocation
+    :return: None
+    """
+    global _profile
+    tracemalloc.start()
+    _profile = {'stages': {}, 'baseline': tracemalloc.take_snapshot()}
+
+
+@contextlib.contextmanager
+def profile_stage(stage):
+    """ Accumulates time and traced memory of one stage, extract, parse or upload, when profiling
+    :param stage: Stage name
+    :return: Context manager
+    """
+    if _profile is None:
+        yield
+        return
+    started = time.time()
+    before, _ = tracemalloc.get_traced_memory()
+    try:
+        yield
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        stats = _profile['stages'].setdefault(stage, {'count': 0, 'seconds': 0.0, 'allocated_bytes': 0,
+                                                      'peak_traced_bytes': 0})
+        stats['count'] += 1
+        stats['seconds'] += time.time() - started
+        stats['allocated_bytes'] += current - before
+        stats['peak_traced_bytes'] = max(stats['peak_traced_bytes'], peak)
+
+
+def report_profile(work_dir_bytes, tmp_files_before):
+    """ Prints the measurements of this invocation as a single JSON line and stops tracing
+    :param work_dir_bytes: Bytes the working directory used before it was removed
+    :param tmp_files_before: Files found in /tmp when the invocation started
+    :return: None
+    """
+    global _profile
+    snapshot = tracemalloc.take_snapshot()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    top_allocations = snapshot.compare_to(_profile['baseline'], 'lineno')[:PROFILE_TOP_ALLOCATIONS]
+    leaked_files = sorted(set(list_tmp_files()) - set(tmp_files_before))
+    # ru_maxrss is in kilobytes on Linux and covers the whole lifetime of a warm container
+    print('PROFILE: ' + json.dumps({
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'peak_traced_bytes': traced_peak,
+        'stages': _profile['stages'],
+        'work_dir_bytes': work_dir_bytes,
+        'tmp_bytes': directory_size(TMP_DIR),
+        'leaked_files': leaked_files,
+        'top_allocations': [str(stat) for stat in top_allocations],
+    }, sort_keys=True))
+    _profile = None
+
+
+def list_tmp_files():
+    return [os.path.join(root, name) for root, _, names in os.walk(TMP_DIR) for name in names]
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names
+               if not os.path.islink(os.path.join(root, name)))
+
+
+def template_upload_extension(product_path):
+    """ Extension of the template as upload_template stores it
+    :param product_path: template path
+    :return: '.json' for a minified template, else the extension of the raw file
+    """
+    if MINIFY_TEMPLATES and canonical_template(product_path) is not None:
+        return '.json'
+    return os.path.splitext(product_path)[1] or '.yaml'
+
+
+def make_template_s3key(vendor_dir, mapping_name, product_name, digest, extension):
+    return ('sc-templates/'
+            + vendor_dir
+            + mapping_name
+            + product_name
+            + '/templates/'
+            + digest + extension
+            )
+
+
+def upload_template(s3_client, product_path, bucket, s3key):
+    """ Uploads a product template, as its minified JSON rendition when MINIFY_TEMPLATES is set
+    :param s3_client: S3 Boto3 client
+    :param product_path: template path
+    :param bucket: S3 Bucket
+    :param s3key: S3 key of the template
+    :return: None
+    """
+    minified = canonical_template(product_path) if MINIFY_TEMPLATES else None
+    if minified is None:
+        s3_client.upload_file(product_path, bucket, s3key)
+        return
+    body = minified.encode('utf-8')
+    raw_size = os.path.getsize(product_path)
+    print("DEBUG: Minified {} from {} to {} bytes ({:.0%})"
+          .format(product_path, raw_size, len(body), float(len(body)) / raw_size))
+    if len(body) > TEMPLATE_URL_MAX_BYTES:
+        print("WARNING: {} exceeds the CloudFormation template size limit of {} bytes"
+              .format(product_path, TEMPLATE_URL_MAX_BYTES))
+    s3_client.put_object(Bucket=bucket, Key=s3key, Body=body, ContentType='application/json')
+
+
+def has_template_changed(s3_client, bucket_name, key):
+    """ Template keys embed the canonical digest, so the template changed if its key does not exist yet
+    :param s3_client: S3 Boto3 client
+    :param bucket_name: S3 Bucket
+    :param key: Content addressed S3 key of the template
+    :return: Boolean, True if the template has to be uploaded
+    """
     try:
         print("DEBUG: Looking for S3 object: {}:{}"
               .format(bucket_name, key))
-        remote_md5 = s3_client.head_object(Bucket=bucket_name, Key=key)['ETag'][1:-1]
-        print("DEBUG: S3 object md5 found: {}".format(remote_md5))
+        s3_client.head_object(Bucket=bucket_name, Key=key)
+        print("DEBUG: S3 object found, no change needed...")
+        return False
     except botocore.exceptions.ClientError:
         print("DEBUG: S3 object not found, change needed...")
-        return True, None, None
-    local_md5 = md5(filename=local_file)
-    if remote_md5 == local_md5:
-        print("DEBUG: local and S3 md5 equal: {}".format(remote_md5))
-        return True, local_md5, remote_md5
+        return True
+
+
+class CloudFormationLoader(yaml.SafeLoader):
+    """ YAML loader understanding CloudFormation short form intrinsic functions such as !Ref and !Sub """
+
+
+# Plain scalars keep their source text: dates such as AWSTemplateFormatVersion: 2010-09-09 stay strings, as
+# CloudFormation reads them, and 1.10, 0755 or yes are not folded into 1.1, 493 or true, which would give edited
+# values the digest of the old ones
+_TEXT_PRESERVED_TAGS = {'tag:yaml.org,2002:' + tag for tag in ('timestamp', 'int', 'float', 'bool')}
+CloudFormationLoader.yaml_implicit_resolvers = {
+    first: [(tag, regexp) for tag, regexp in resolvers if tag not in _TEXT_PRESERVED_TAGS]
+    for first, resolvers in yaml.SafeLoader.yaml_implicit_resolvers.items()
+}
+
+
+def _construct_intrinsic(loader, tag_suffix, node):
+    """ Expands a short form intrinsic (!GetAtt a.b) into its long form ({"Fn::GetAtt": ["a", "b"]}) """
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
     else:
-        print("DEBUG: local and S3 md5 different: {}!={}"
-              .format(local_md5, remote_md5))
-        return False, local_md5, remote_md5
+        value = loader.construct_mapping(node, deep=True)
+    if tag_suffix == 'GetAtt' and isinstance(value, str):
+        value = value.split('.', 1)
+    if tag_suffix in ('Ref', 'Condition'):
+        return {tag_suffix: value}
+    return {'Fn::' + tag_suffix: value}
+
+
+CloudFormationLoader.add_multi_constructor('!', _construct_intrinsic)
+
+_canonical_templates = {}
+
+
+def load_template(filename):
+    """ Parses a JSON or YAML CloudFormation template into plain python objects
+    :param filename: template path
+    :return: Parsed template, short form intrinsics expanded to their long form
+    """
+    with open(filename, 'r') as stream:
+        content = stream.read()
+    try:
+        # Numbers keep their source text as well, 1.10 and 1.1 are different template values
+        return json.loads(content, parse_int=str, parse_float=str)
+    except ValueError:
+        return yaml.load(content, Loader=CloudFormationLoader)
+
+
+def canonicalize_template(filename):
+    """ Normalized rendition of a template: comments, formatting, key order and short form tags do not affect it.
+        It is also a valid, minified JSON template.
+    :param filename: template path
+    :return: Canonical JSON string
+    """
+    return json.dumps(load_template(filename), sort_keys=True, separators=(',', ':'))
+
+
+def canonical_template(filename):
+    """ Canonical form of a template, cached per raw md5 so each distinct file content is canonicalized once
+    :param filename: template path
+    :return: Canonical JSON string, None if the template could not be parsed
+    """
+    raw_md5 = md5(filename=filename)
+    if raw_md5 not in _canonical_templates:
+        try:
+            _canonical_templates[raw_md5] = canonicalize_template(filename)
+        except (ValueError, yaml.YAMLError) as e:
+            print("DEBUG: Could not canonicalize {}: {}".format(filename, e))
+            _canonical_templates[raw_md5] = None
+    return _canonical_templates[raw_md5]
+
+
+def template_digest(filename):
+    """ Digest of the canonical form of a template, used for change detection and S3 keys
+    :param filename: template path
+    :return: md5 hex digest, the raw md5 if the template could not be parsed
+    """
+    canonical = canonical_template(filename)
+    if canonical is None:
+        return md5(filename=filename)
+    return hashlib.md5(canonical.encode('utf-8')).hexdigest()
+
 
 def md5(filename):
     hash_md5 = hashlib.md5()
@@ -199,7 +739,7 @@ def md5(filename):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
-def update_portfolio(portfolio_obj, mapping_obj, bucket):
+def update_portfolio(portfolio_obj, mapping_obj, bucket, grant_bucket_access=True):
     """ Pseudo code as 
         1. Make describe_portfolio call
         2. Call update_portfolio to remove all tags and sync Description and ProviderName as mentioned in mapping file object
@@ -211,15 +751,13 @@ def update_portfolio(portfolio_obj, mapping_obj, bucket):
     :param portfolio_obj: Portfolio Object as retrieved from boto3 call
     :param mapping_obj: mapping.yaml file object
     :param bucket: S3 Bucket
+    :param grant_bucket_access: False when the caller already updated the bucket policy, see grant_template_access
     :return: 
     """
     _update_portfolio_tags(PortfolioId=portfolio_obj['Id'], mapping_obj=mapping_obj)
-    bucket_policy = get_bucket_policy(bucket)
-    policy = json.loads(bucket_policy['Policy'])
-    statements = policy['Statement']
-    statements, accounts_obj = _append_accounts_to_statements(statements, mapping_obj)
-    policy['Statement'] = statements
-    put_bucket_policy(json.dumps(policy), bucket)
+    if grant_bucket_access:
+        grant_template_access([mapping_obj], bucket)
+    accounts_obj = _get_mapping_accounts(mapping_obj)
     share_portfolio(accounts_obj, portfolio_obj['Id'])
     remove_portfolio_share(accounts_obj, portfolio_obj['Id'])
 
@@ -385,7 +923,7 @@ def create_provisioning_artifact(objProduct, productid, s3objectkey):
     )
 
 
-def create_portfolio(mapping_obj, bucket):
+def create_portfolio(mapping_obj, bucket, grant_bucket_access=True):
     """
     
     :param mapping_obj: Object of the mapping file
@@ -409,26 +947,46 @@ def create_portfolio(mapping_obj, bucket):
             IdempotencyToken=str(uuid.uuid4())
         )
 
+    if grant_bucket_access:
+        grant_template_access([mapping_obj], bucket)
+    accounts_obj = _get_mapping_accounts(mapping_obj)
+    share_portfolio(accounts_obj, response['PortfolioDetail']['Id'])
+    remove_portfolio_share(accounts_obj, response['PortfolioDetail']['Id'])
+    return response
+
+
+def grant_template_access(mapping_objs, bucket):
+    """ Gives the accounts of the mappings read access to the product templates with one bucket policy update.
+    The policy is read, modified and written back, so concurrent callers would overwrite each other's grants;
+    in coordinator mode only the coordinator calls this, for all mappings at once.
+    :param mapping_objs: mapping.yaml file objects
+    :param bucket: S3 Bucket holding the templates
+    :return: None
+    """
     bucket_policy = get_bucket_policy(bucket)
     policy = json.loads(bucket_policy['Policy'])
     statements = policy['Statement']
-    statements, accounts_obj = _append_accounts_to_statements(statements, mapping_obj)
+    for mapping_obj in mapping_objs:
+        statements = _append_accounts_to_statements(statements, mapping_obj, bucket)
     policy['Statement'] = statements
     put_bucket_policy(json.dumps(policy), bucket)
-    share_portfolio(accounts_obj, response['PortfolioDetail']['Id'])
-    remove_portfolio_share(accounts_obj, response['PortfolioDetail']['Id'])
-    return response
 
-def _append_accounts_to_statements(statements, mapping_obj):
+
+def _get_mapping_accounts(mapping_obj):
     accounts_obj = []
-    if 'accounts' in mapping_obj:
-        for account in mapping_obj['accounts']:
-            if check_if_account_is_integer(account['number']) and str(account['number']) != accountid:
-                accounts_obj.append(str(account['number']))
+    for account in mapping_obj.get('accounts', []):
+        if check_if_account_is_integer(account['number']) and str(account['number']) != accountid:
+            accounts_obj.append(str(account['number']))
+    return accounts_obj
+
+
+def _append_accounts_to_statements(statements, mapping_obj, bucket):
+    accounts_obj = _get_mapping_accounts(mapping_obj)
+    if accounts_obj:
         accounts_to_add = get_accounts_to_append(statements, accounts_obj, bucket)
         if accounts_to_add:
             statements.append(create_policy(accounts_to_add, bucket))
-    return statements, accounts_obj
+    return statements
 
 def remove_portfolio_share(lst_accounts, PortfolioId):
     """ Removes the portfolio share
@@ -545,7 +1103,7 @@ def get_accounts_to_append(statements, lstaccounts, s3bucket):
     boolmatchfolder = False
 
     for statement in statements:
-        if type(statement['Resource']) is unicode:
+        if type(statement['Resource']) is str:
             if statement['Resource'] == "arn:aws:s3:::" + s3bucket + "/sc-templates/*":
                 boolmatchfolder = True
         else:
@@ -557,9 +1115,9 @@ def get_accounts_to_append(statements, lstaccounts, s3bucket):
         objexistingprincipals = []
 
         for statement in statements:
-            if type(statement['Resource']) is unicode:
+            if type(statement['Resource']) is str:
                 if statement['Resource'] == "arn:aws:s3:::" + s3bucket + "/sc-templates/*":
-                    if type(statement['Principal']['AWS']) is unicode:
+                    if type(statement['Principal']['AWS']) is str:
                         if statement['Principal']['AWS'] not in objexistingprincipals:
                             objexistingprincipals.append(statement['Principal']['AWS'])
                     else:
@@ -622,12 +1180,14 @@ def setup_s3_client():
     return session.client('s3')
 
 
-def put_job_success(job, message):
+def put_job_success(job, message, continuation_token=None):
     """Notify CodePipeline of a successful job
 
     Args:
         job: The CodePipeline job ID
         message: A message to be logged relating to the job status
+        continuation_token: When set, CodePipeline invokes the function again with it instead of
+            completing the action
 
     Raises:
         Exception: Any exception thrown by .put_job_success_result()
@@ -635,7 +1195,10 @@ def put_job_success(job, message):
     """
     print('Putting job success')
     print(message)
-    code_pipeline.put_job_success_result(jobId=job)
+    if continuation_token:
+        code_pipeline.put_job_success_result(jobId=job, continuationToken=continuation_token)
+    else:
+        code_pipeline.put_job_success_result(jobId=job)
 
 
 def put_job_failure(job, message):